@@ -0,0 +1,222 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import httpx
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from utils import utils
+
+MOCK_SERVER = os.path.join(parent_dir, "utils", "mock_server.py")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Throughput and tail latency of the utils request engine against "
+                                                 "the local mock server.")
+    parser.add_argument('--requests', type=int, default=500, help='Requests per case')
+    parser.add_argument('--workers', type=str, default='8,32,128', help='max_workers values to sweep')
+    parser.add_argument('--payload-chars', type=str, default='200,4000,32000', help='Prompt sizes to sweep')
+    parser.add_argument('--response-tokens', type=str, default='20,200,1000', help='Response lengths to sweep')
+    parser.add_argument('--error-rates', type=str, default='0,0.05', help='Injected 5xx rates to sweep')
+    parser.add_argument('--latency', type=str, default='0.05', help='Mock time to first token, see mock_server')
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help='Mock generation speed, 0 for instant')
+    parser.add_argument('--grid', action='store_true',
+                        help='Run the full cartesian product instead of varying one parameter at a time')
+    parser.add_argument('--stream', action='store_true', help='Stream responses (stop_when on the closing tag)')
+    parser.add_argument('--port', type=int, default=18480, help='Port for the mock server')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report here instead of stdout')
+    return parser.parse_args()
+
+
+def _values(spec, cast):
+    return [cast(x) for x in spec.split(",") if x]
+
+
+def cases(args):
+    axes = {"max_workers": _values(args.workers, int), "payload_chars": _values(args.payload_chars, int),
+            "response_tokens": _values(args.response_tokens, int), "error_rate": _values(args.error_rates, float)}
+    if args.grid:
+        return [dict(zip(axes, values)) for values in itertools.product(*axes.values())]
+    # One parameter at a time around the first value of every axis
+    baseline = {name: values[0] for name, values in axes.items()}
+    result = [baseline]
+    for name, values in axes.items():
+        result += [dict(baseline, **{name: value}) for value in values[1:]]
+    return result
+
+
+class MockServerProcess(object):
+    """Mock server in a child process, so its memory and threads are not counted against the client."""
+
+    def __init__(self, port, latency, tokens_per_second, response_tokens, error_rate):
+        self.url = f"http://127.0.0.1:{port}"
+        self.process = subprocess.Popen(
+            [sys.executable, MOCK_SERVER, "--host", "127.0.0.1", "--port", str(port), "--latency", latency,
+             "--tokens-per-second", str(tokens_per_second), "--response-tokens", str(response_tokens),
+             "--error-rate", str(error_rate), "--seed", "0"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def __enter__(self):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                httpx.get(self.url + "/models", timeout=1)
+                return self
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        self.process.kill()
+        raise RuntimeError(f"Mock server did not start on {self.url}")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+        return False
+
+
+class ResourceSampler(object):
+    """Peak RSS and thread counts of this process, sampled on a background thread."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_rss_mb = 0.0
+        self.peak_threads = 0
+        self.peak_python_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current():
+        # /proc gives the current values on Linux; elsewhere fall back to the lifetime peak RSS
+        rss_mb, threads = None, threading.active_count()
+        try:
+            with open("/proc/self/status", 'r') as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss_mb = int(line.split()[1]) / 1024
+                    elif line.startswith("Threads:"):
+                        threads = int(line.split()[1])
+        except OSError:
+            pass
+        if rss_mb is None:
+            scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+            rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        return rss_mb, threads
+
+    def _sample(self):
+        rss_mb, threads = self.current()
+        self.peak_rss_mb = max(self.peak_rss_mb, rss_mb)
+        self.peak_threads = max(self.peak_threads, threads)
+        self.peak_python_threads = max(self.peak_python_threads, threading.active_count())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def run_case(case, args, url):
+    sent = {}
+
+    def test_data():
+        # Timestamp each item as the engine pulls it, i.e. when it is submitted
+        for i in range(args.requests):
+            sent[i] = time.monotonic()
+            # The index keeps every prompt distinct, so nothing is de-duplicated
+            yield {"id": i, "input_ques": [{"role": "user", "content": f"{i} Weighted Score " +
+                                            "x" * max(0, case["payload_chars"] - 20)}]}
+
+    latencies = []
+    failed = 0
+    options = {"stop_when": "<The End of Evaluation Result>"} if args.stream else {}
+    with ResourceSampler() as sampler:
+        start = time.monotonic()
+        for responses, obj in utils.process_data_async(test_data(), "mock", 1, url, "any", {},
+                                                       max_workers=case["max_workers"], total=args.requests,
+                                                       return_failures=True, stage="benchmark",
+                                                       telemetry_dir="", **options):
+            if isinstance(responses, Exception):
+                failed += 1
+                continue
+            latencies.append(time.monotonic() - sent[obj["id"]])
+        seconds = time.monotonic() - start
+    latencies.sort()
+    return {
+        "params": case, "requests": args.requests, "ok": len(latencies), "failed": failed,
+        "seconds": round(seconds, 3), "requests_per_second": round(len(latencies) / seconds, 2),
+        "latency_seconds": {"mean": sum(latencies) / len(latencies) if latencies else None,
+                            "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+                            "p99": percentile(latencies, 0.99)},
+        "peak_rss_mb": round(sampler.peak_rss_mb, 1), "peak_threads": sampler.peak_threads,
+        "peak_python_threads": sampler.peak_python_threads,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=parent_dir, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    # Every request has to reach the server
+    os.environ.pop("FEEDBACKER_RESPONSE_CACHE", None)
+    report = {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+              "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "config": {"requests": args.requests, "latency": args.latency,
+                         "tokens_per_second": args.tokens_per_second, "stream": args.stream},
+              "cases": []}
+    # Cases sharing a server configuration reuse one mock server process
+    all_cases = cases(args)
+    server_keys = sorted({(case["response_tokens"], case["error_rate"]) for case in all_cases})
+    for response_tokens, error_rate in server_keys:
+        with MockServerProcess(args.port, args.latency, args.tokens_per_second, response_tokens, error_rate) as server:
+            for case in all_cases:
+                if (case["response_tokens"], case["error_rate"]) != (response_tokens, error_rate):
+                    continue
+                print(f"Running {case}", file=sys.stderr)
+                # The engine's progress output goes to stderr, keeping stdout for the JSON report
+                with contextlib.redirect_stdout(sys.stderr):
+                    result = run_case(case, args, server.url)
+                print(f"  {result['requests_per_second']} req/s, p50 {result['latency_seconds']['p50']}, "
+                      f"p99 {result['latency_seconds']['p99']}", file=sys.stderr)
+                report["cases"].append(result)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+        print(f"Benchmark report saved to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
 import os
 import argparse
-import json
 from tqdm import tqdm
 import sys
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -15,6 +14,11 @@ def parse_args():
     parser.add_argument('--base_url', type=str, default='http://localhost:8404', help='Base URL for the model API')
     parser.add_argument('--api_key', type=str, default='any', help='API key for authentication')
     parser.add_argument('--max_workers', type=int, default=32, help='Maximum number of parallel workers')
+    parser.add_argument('--sample_num', type=int, default=1, help='Number of responses to generate per prompt')
+    parser.add_argument('--use_n', action='store_true',
+                        help='Ask for all sample_num responses in one request with `n` (if the endpoint supports it)')
+    parser.add_argument('--batch', type=str, default=None, choices=['local', 'openai'],
+                        help='Run as a batch job: "openai" uses the Batch API, "local" a stand-in for servers without one')
     args = parser.parse_args()
     return args
 
@@ -36,7 +40,7 @@ if __name__ == "__main__":
 
     generation_params = {}
     output_path = "outputs/"
-    sample_num = 1
+    sample_num = args.sample_num
     max_workers = args.max_workers
     model = args.model
     base_url = args.base_url
@@ -54,30 +58,23 @@ if __name__ == "__main__":
     # ============================================================================
     # Obtain the final results based on the prompt above
     arena_data_with_label_save_path = os.path.join(output_path, f"generation/{model}.jsonl")
-    # Read processed unique_id
-    processed_unique_ids = set()
-    if os.path.exists(arena_data_with_label_save_path):
-        with open(arena_data_with_label_save_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line)
-                    unique_id = data.get('id', None)
-                    if unique_id is not None:
-                        processed_unique_ids.add(unique_id)
-                except json.JSONDecodeError:
-                    print(f"Warning: JSON decode error in line: {line}")
     # Filter processed data items
-    unprocessed_data = [obj for obj in test_data if obj.get('id', None) not in processed_unique_ids]
+    unprocessed_data = utils.filter_processed_data(test_data, arena_data_with_label_save_path)
     print("Remaining data to process:", len(unprocessed_data))
 
     if len(unprocessed_data) != 0:
         # Obtain LLM generated results and save them in real-time
-        with open(arena_data_with_label_save_path, 'a', encoding='utf-8') as f:
-            for responses, obj in utils.process_data_async(unprocessed_data, model, sample_num, base_url, api_key, generation_params, max_workers):
+        if args.batch:
+            results = utils.process_data_batch(unprocessed_data, model, sample_num, base_url, api_key, generation_params,
+                                               os.path.join(output_path, "batch"), job_name=f"generation_{model}",
+                                               backend=args.batch, max_workers=max_workers)
+        else:
+            results = utils.process_data_async(unprocessed_data, model, sample_num, base_url, api_key, generation_params, max_workers,
+                                               use_n=args.use_n)
+        with utils.JsonlWriter(arena_data_with_label_save_path) as f:
+            for responses, obj in results:
                 obj["responses"] = responses
-                f.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                f.flush()
-                os.fsync(f.fileno())
+                f.write(obj)
 
     # Process previously failed parsing
     arena_data_with_label = utils.read_jsonl_file(arena_data_with_label_save_path)
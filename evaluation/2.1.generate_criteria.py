@@ -1,10 +1,8 @@
-import copy
 import os
-import json
-import random
 from tqdm import tqdm
 import pandas as pd
 import re
+import string
 import sys
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
@@ -52,85 +50,87 @@ def get_input_data(df_majority_vote, system_prompt, user_prompt, saved_criteria,
     return input_data
 
 
-def get_input_eval(df_majority_vote, prompt, model, base_urls, api_key, id_key_name, use_baseline_ans, max_number=None):
-    input_data = []
-    for i, row in tqdm(df_majority_vote.iterrows(), total=len(df_majority_vote)):
-        try:
-            obj = row.to_dict()
-
-            obj_new = copy.deepcopy(obj)
-            obj_new[id_key_name] = obj_new[id_key_name] + "_a"
-            if not use_baseline_ans:
-                obj_new["input_ques"] = [{"role": "user", "content": prompt.format(question=obj_new['prompt'], eval_system=obj_new['criteria'], answer=obj_new['response_a'])}]
-            else:
-                obj_new["input_ques"] = [{"role": "user", "content": prompt.format(question=obj_new['prompt'], eval_system=obj_new['criteria'], answer=obj_new['response_b'], answer_baseline=obj['ques2ans_responses'][0]['response'])}]
-            obj_new["query_model"] = model
-            obj_new["query_base_url"] = random.choice(base_urls)
-            obj_new["query_api_key"] = api_key
-            input_data.append(obj_new)
-
-            obj_new = copy.deepcopy(obj)
-            obj_new[id_key_name] = obj_new[id_key_name] + "_b"
+def get_input_eval(input_data, prompt, model, base_urls, api_key, id_key_name, use_baseline_ans, max_number=None):
+    # One request per response of each pair, ids suffixed with _a / _b
+    def render(answer_key):
+        def messages(obj):
             if not use_baseline_ans:
-                obj_new["input_ques"] = [{"role": "user", "content": prompt.format(question=obj_new['prompt'], eval_system=obj_new['criteria'], answer=obj_new['response_b'])}]
+                content = prompt.format(question=obj['prompt'], eval_system=obj['criteria'], answer=obj[answer_key])
             else:
-                obj_new["input_ques"] = [{"role": "user", "content": prompt.format(question=obj_new['prompt'], eval_system=obj_new['criteria'], answer=obj_new['response_b'], answer_baseline=obj['ques2ans_responses'][0]['response'])}]
-            obj_new["query_model"] = model
-            obj_new["query_base_url"] = random.choice(base_urls)
-            obj_new["query_api_key"] = api_key
-            input_data.append(obj_new)
+                content = prompt.format(question=obj['prompt'], eval_system=obj['criteria'], answer=obj[answer_key],
+                                        answer_baseline=obj['ques2ans_responses'][0]['response'])
+            return [{"role": "user", "content": content}]
+        return messages
 
-        except Exception as e:
-            print(f"Error at index {i}: {e}")
+    return (utils.build_requests(input_data, render('response_a'), model, base_urls, api_key, id_suffix="_a",
+                                 id_key_name=id_key_name) +
+            utils.build_requests(input_data, render('response_b'), model, base_urls, api_key, id_suffix="_b",
+                                 id_key_name=id_key_name))
 
-    return input_data
 
+def get_input_data_ques2ans(input_data, prompt, max_number=None):
+    return utils.build_requests(input_data, lambda obj: [{"role": "user", "content": prompt.format(question=obj['prompt'])}])
 
-def get_input_data_ques2ans(df_majority_vote, prompt, max_number=None):
-    input_data = []
-    for i, row in tqdm(df_majority_vote.iterrows(), total=len(df_majority_vote)):
-        try:
-            obj = row.to_dict()
-            obj["input_ques"] = [{"role": "user", "content": prompt.format(question=row['prompt'])}]
-            input_data.append(obj)
-        except Exception as e:
-            print(f"Error at index {i}: {e}")
-    return input_data
 
+def reference_answers(ques2ans_responses):
+    # answer_1 ... answer_k template fields, one per reference model
+    return {f"answer_{i + 1}": res["response"] for i, res in enumerate(ques2ans_responses)}
 
-def get_input_get_criteria(df_majority_vote, prompt, model, base_urls, api_key, max_number=None):
-    input_data = []
-    for i, row in tqdm(df_majority_vote.iterrows(), total=len(df_majority_vote)):
-        try:
-            input_ques = prompt.format(question=row['prompt'],
-                                       answer_1=row['ques2ans_responses'][0]["response"],
-                                       answer_2=row['ques2ans_responses'][1]["response"],
-                                       answer_3=row['ques2ans_responses'][2]["response"])
-            obj = row.to_dict()
-            obj["input_ques"] = [{"role": "user", "content": input_ques}]
-            obj["query_model"] = model
-            obj["query_base_url"] = random.choice(base_urls)
-            obj["query_api_key"] = api_key
-            input_data.append(obj)
-        except Exception as e:
-            print(f"Error at index {i}: {e}")
-    return input_data
 
+def check_answer_fields(template, num_models, name):
+    # Each reference model fills one {answer_i} block of the template: answers beyond the last block would be left
+    # out of the prompt silently, and a block without an answer fails every request
+    fields = {field for _, field, _, _ in string.Formatter().parse(template)
+              if field is not None and re.fullmatch(r"answer_\d+", field)}
+    expected = {f"answer_{i + 1}" for i in range(num_models)}
+    if fields != expected:
+        raise ValueError(f"{name} has the answer fields {sorted(fields, key=lambda field: int(field[7:]))}, "
+                         f"but {num_models} reference models are configured")
+
+
+def get_input_get_criteria(input_data, prompt, model, base_urls, api_key, max_number=None):
+    def render(obj):
+        content = prompt.format(question=obj['prompt'], **reference_answers(obj['ques2ans_responses']))
+        return [{"role": "user", "content": content}]
+    return utils.build_requests(input_data, render, model, base_urls, api_key)
+
+
+def get_input_get_weights(input_data, system_prompt, user_prompt, max_number=None):
+    def render(obj):
+        content = user_prompt.format(question=obj['prompt'], metrics=obj['get_criteria'],
+                                     **reference_answers(obj['ques2ans_responses']))
+        return [{"role": "system", "content": system_prompt}, {"role": "user", "content": content}]
+    return utils.build_requests(input_data, render)
 
-def get_input_get_weights(df_majority_vote, system_prompt, user_prompt, max_number=None):
-    input_data = []
-    for i, row in tqdm(df_majority_vote.iterrows(), total=len(df_majority_vote)):
-        try:
-            input_ques = user_prompt.format(question=row['prompt'], metrics=row['get_criteria'],
-                                            answer_1=row['ques2ans_responses'][0]["response"],
-                                            answer_2=row['ques2ans_responses'][1]["response"],
-                                            answer_3=row['ques2ans_responses'][2]["response"])
-            obj = row.to_dict()
-            obj["input_ques"] = [{"role": "system", "content": system_prompt}, {"role": "user", "content": input_ques}]
-            input_data.append(obj)
-        except Exception as e:
-            print(f"Error at index {i}: {e}")
-    return input_data
+
+def join_ques2ans_responses(input_data, ques2ans_models, generation_dir):
+    """
+    Attach the reference answer of every model in ques2ans_models to each question, looked up by id in the
+    model's generation file. Questions missing from any reference file are dropped and reported.
+    """
+    indexes = [utils.index_jsonl_file(os.path.join(generation_dir, f"{m['model_name']}.jsonl")) for m in ques2ans_models]
+    missing = {m["model_name"]: [] for m in ques2ans_models}
+    new_data = []
+    for obj in input_data:
+        ques2ans_responses = []
+        for i, (model_info, index) in enumerate(zip(ques2ans_models, indexes)):
+            ref_obj = index.get(obj["id"])
+            if ref_obj is None:
+                missing[model_info["model_name"]].append(obj["id"])
+                continue
+            ques2ans_responses.append({"ques2ans_res_id": i + 1, "model_name": model_info["model_name"],
+                                       "response": ref_obj["responses"][0]})
+        if len(ques2ans_responses) == len(ques2ans_models):
+            obj["ques2ans_responses"] = ques2ans_responses
+            new_data.append(obj)
+    for index in indexes:
+        index.close()
+
+    for model_name, ids in missing.items():
+        if ids:
+            print(f"{len(ids)} ids missing from the answers of {model_name}, e.g. {ids[:5]}")
+    print(f"Joined reference answers of {len(ques2ans_models)} models for {len(new_data)} questions")
+    return new_data
 
 
 def extract_criteria(text):
@@ -166,24 +166,6 @@ def extract_score(raw_string: str) -> float:
     return None
 
 
-def filter_processed_data(full_data, save_path_to_test, id_key_name):
-    # Read processed unique_id
-    processed_unique_ids = set()
-    if os.path.exists(save_path_to_test):
-        with open(save_path_to_test, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line)
-                    unique_id = data.get(id_key_name, None)
-                    if unique_id is not None:
-                        processed_unique_ids.add(unique_id)
-                except json.JSONDecodeError:
-                    print(f"Warning: JSON decode error in line: {line}")
-    # Filter processed data items
-    unprocessed_data = [obj for obj in full_data if obj.get('id', None) not in processed_unique_ids]
-    return unprocessed_data
-
-
 def main():
 
     output_path = "outputs/"
@@ -198,31 +180,12 @@ def main():
     ques2ans_models = [{"model_name": "gpt-4o", "base_url": "http://localhost:8004", "api_key": "any"},
                        {"model_name": "deepseek-v3", "base_url": "http://localhost:8004", "api_key": "any"},
                        {"model_name": "doubao-pro-1.5-32k", "base_url": "http://localhost:8004", "api_key": "any"}]
+    # The criteria prompt needs one answer block per reference model, checked before any work is done
+    prompt_path_get_criteria = "./prompts/ours/ours_get_criteria.md"
+    check_answer_fields(utils.read_prompt(prompt_path_get_criteria), len(ques2ans_models), prompt_path_get_criteria)
     input_data_path = "./data/evaluation_dataset_v0.1.jsonl"
-    input_data = utils.read_jsonl_file(input_data_path)
-    ques2ans_data_1 = utils.read_jsonl_file(os.path.join(output_path, f"generation/{ques2ans_models[0]['model_name']}.jsonl"))
-    ques2ans_data_2 = utils.read_jsonl_file(os.path.join(output_path, f"generation/{ques2ans_models[1]['model_name']}.jsonl"))
-    ques2ans_data_3 = utils.read_jsonl_file(os.path.join(output_path, f"generation/{ques2ans_models[2]['model_name']}.jsonl"))
-    new_data = []
-    for obj in input_data:
-        for temp_obj in ques2ans_data_1:
-            if obj["id"] == temp_obj["id"]:
-                obj1 = temp_obj
-                break
-        for temp_obj in ques2ans_data_2:
-            if obj["id"] == temp_obj["id"]:
-                obj2 = temp_obj
-                break
-        for temp_obj in ques2ans_data_3:
-            if obj["id"] == temp_obj["id"]:
-                obj3 = temp_obj
-                break
-        obj["ques2ans_responses"] = [
-            {"ques2ans_res_id": 1, "model_name": ques2ans_models[0]["model_name"], "response": obj1["responses"][0]},
-            {"ques2ans_res_id": 2, "model_name": ques2ans_models[1]["model_name"], "response": obj2["responses"][0]},
-            {"ques2ans_res_id": 3, "model_name": ques2ans_models[2]["model_name"], "response": obj3["responses"][0]},
-        ]
-        new_data.append(obj)
+    new_data = join_ques2ans_responses(utils.iter_jsonl_file(input_data_path), ques2ans_models,
+                                       os.path.join(output_path, "generation"))
     save_path = os.path.join(output_path, "ours_ques2ans_3.jsonl")  # Save directory
     utils.write_jsonl_file(new_data, save_path)
     # ============================================================================
@@ -232,7 +195,6 @@ def main():
     print("=" * 50)
     print("Generating criteria and weights")
     # Configuration
-    prompt_path_get_criteria = "./prompts/ours/ours_get_criteria.md"
     prompt = utils.read_prompt(prompt_path_get_criteria)
     model_info = {
         "model_name": "QwQ-32B",
@@ -247,23 +209,22 @@ def main():
     input_data_path = "./outputs/ours_ques2ans_3.jsonl"
     input_data = utils.read_jsonl_file(input_data_path)
     model, base_urls, api_key = model_info["model_name"], model_info["base_urls"], model_info["api_key"]
-    test_data = get_input_get_criteria(pd.DataFrame(input_data), prompt, model, base_urls, api_key)
+    test_data = get_input_get_criteria(input_data, prompt, model, base_urls, api_key)
     save_path = os.path.join(output_path, "ours_get_criteria.jsonl")  # Save directory
 
     # Obtain LLM generated results and save them in real-time
-    unprocessed_data = filter_processed_data(test_data, save_path, id_key_name)
+    unprocessed_data = utils.filter_processed_data(test_data, save_path, id_key_name)
     print("Remaining data to process:", len(unprocessed_data))
     if len(unprocessed_data) != 0:
-        with open(save_path, 'a', encoding='utf-8') as f:
-            for responses, obj in utils.process_data_async_spe_model(unprocessed_data, sample_num, generation_params, max_workers=max_workers):
+        with utils.JsonlWriter(save_path, index_key=id_key_name) as f:
+            # Answers without criteria in the expected format are asked again right away
+            for criteria, obj in utils.process_data_async_spe_model(unprocessed_data, sample_num, generation_params, max_workers=max_workers,
+                                                                    parse=lambda responses: extract_criteria(responses[0])):
                 for key in ['query_model', 'query_base_url', 'query_api_key', 'input_ques']:
                     if key in obj:
                         del obj[key]
-                obj["criteria"] = extract_criteria(responses[0])
-                if obj["criteria"]:
-                    f.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                    f.flush()
-                    os.fsync(f.fileno())
+                obj["criteria"] = criteria
+                f.write(obj)
 
     criteria_data = utils.read_jsonl_file(save_path)
     print(f"Filtered data saved to {save_path}, total valid entries: {len(criteria_data)}")
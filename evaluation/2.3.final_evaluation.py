@@ -1,15 +1,13 @@
-import subprocess
 import os
 import argparse
-import json
-import random
+import itertools
 import sys
 from tqdm import tqdm
 import re
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
-from utils import utils
+from utils import utils, errors
 
 
 # Enable during debugging
@@ -17,29 +15,32 @@ from utils import utils
 # logger = logging.getLogger(__name__)
 
 
-def get_input_eval(aux_data, generation_data, prompt, model, base_urls, api_key, id_key_name):
-    input_data = []
-    for i, obj in enumerate(tqdm(aux_data, total=len(aux_data))):
+def get_input_eval(aux_data, generation_index, prompt, model, base_urls, api_key, id_key_name):
+    # Streams aux_data and looks each id up in the generation file's index, yielding the requests one at a time
+    num_missing = 0
+    for i, obj in enumerate(tqdm(aux_data)):
         try:
-            obj_gene = None
-            for temp_obj in generation_data:
-                if temp_obj[id_key_name] == obj[id_key_name]:
-                    obj_gene = temp_obj
-                    break
+            obj_gene = generation_index.get(obj[id_key_name])
             if obj_gene is None:
+                num_missing += 1
                 continue  # Skip this obj if not found
-            obj["input_ques"] = [{"role": "user", "content": prompt.format(
-                question=obj['prompt'], eval_system=obj['criteria'], answer=obj_gene["responses"][0],
-                answer_baseline=obj['ques2ans_responses'][0]['response'],
-                critic_baseline=obj['ques2ans_responses'][0]['score'])}]
+            # Everything about the question (criteria, baseline answer and its critique) is the prefix shared by all
+            # the candidate models judged on it; only the candidate's answer follows
+            content = prompt.bind(question=obj['prompt'], eval_system=obj['criteria'],
+                                  answer_baseline=obj['ques2ans_responses'][0]['response'],
+                                  critic_baseline=obj['ques2ans_responses'][0]['score']).format(
+                answer=obj_gene["responses"][0])
+            obj["input_ques"] = [{"role": "user", "content": content}]
             obj["query_model"] = model
-            obj["query_base_url"] = random.choice(base_urls)
+            obj["query_base_url"] = base_urls  # Chosen per request by the load balancer
             obj["query_api_key"] = api_key
             obj["responses"] = obj_gene["responses"]
-            input_data.append(obj)
+            yield obj
         except Exception as e:
             print(f"Error at index {i}: {e}")
-    return input_data
+    if num_missing:
+        print(f"{num_missing} questions have no generation output and are skipped")
+    prompt.report()
 
 
 def extract_score(raw_string: str) -> float:
@@ -53,27 +54,13 @@ def extract_score(raw_string: str) -> float:
     return None
 
 
-def filter_processed_data(full_data, save_path_to_test):
-    # Read processed unique_id
-    processed_unique_ids = set()
-    if os.path.exists(save_path_to_test):
-        with open(save_path_to_test, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line)
-                    unique_id = data.get('id', None)
-                    if unique_id is not None:
-                        processed_unique_ids.add(unique_id)
-                except json.JSONDecodeError:
-                    print(f"Warning: JSON decode error in line: {line}")
-    # Filter processed data items
-    unprocessed_data = [obj for obj in full_data if obj.get('id', None) not in processed_unique_ids]
-    return unprocessed_data
-
-
 def parse_args():
     parser = argparse.ArgumentParser(description="Script for evaluation task.")
     parser.add_argument('--model', type=str, default='gpt-4o', help='Model name to use')
+    parser.add_argument('--batch', type=str, default=None, choices=['local', 'openai'],
+                        help='Run as a batch job: "openai" uses the Batch API, "local" a stand-in for servers without one')
+    parser.add_argument('--max_parse_attempts', type=int, default=5,
+                        help='Ask up to this many times in all for items whose score cannot be parsed')
     args = parser.parse_args()
     return args
 
@@ -92,12 +79,13 @@ def main():
     aux_data_path = os.path.join(output_path, "data_for_ours_eval_baseline.jsonl")
     # Prompt used for evaluation
     prompt_path_get_eval = "./prompts/ours/ours_baseline_final_judge.md"
-    prompt = utils.read_prompt(prompt_path_get_eval)
+    prompt = utils.load_prompt_template(prompt_path_get_eval)
     # Evaluation model parameters
     model_info = {
         "model_name": "QwQ-32B",
         "base_urls": ["http://localhost:8004", "http://localhost:8004"],
-        "api_key": "any"
+        "api_key": "any",
+        "reasoning": True
     }
     generation_params = {}
     sample_num = 1
@@ -110,33 +98,59 @@ def main():
     # 2.2. Obtain score
     print("=" * 50)
     print("Generating final evaluation scores based on criteria and weights; model is:", args.model)
-    generation_data = utils.read_jsonl_file(generation_data_path)
-    aux_data = utils.read_jsonl_file(aux_data_path)
-    test_data = get_input_eval(aux_data, generation_data, prompt, model, base_urls, api_key, id_key_name)
-    print(len(test_data))
-
-    # Obtain LLM generated results and save them in real-time
-    unprocessed_data = filter_processed_data(test_data, save_path)
-    print("Remaining data to process:", len(unprocessed_data))
-
-    if len(unprocessed_data) != 0:
-        with open(save_path, 'a', encoding='utf-8') as f:
-            for responses, obj in utils.process_data_async_spe_model(unprocessed_data, sample_num, generation_params, max_workers=max_workers):
-                for key in ['query_model', 'query_base_url', 'query_api_key', 'input_ques']:
-                    if key in obj:
-                        del obj[key]
-                obj["score"] = extract_score(responses[0])
-                if obj["score"] != None:
-                    f.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                    f.flush()
-                    os.fsync(f.fileno())
-
-    # Process previously failed parsing
-    score_data = utils.read_jsonl_file(save_path)
-    print("Current length:", len(score_data))
-    if len(test_data) != len(score_data):
-        subprocess.run(['python', '2.3.final_evaluation.py', '--model', args.model])
-    else:
+    # Requests are built, filtered against the output and judged as the engine pulls them, so neither the input
+    # nor the generation outputs are held in memory; generation outputs are read by id as needed
+    # Judgements without a parsable score are asked again right away, up to max_parse_attempts times in all; the
+    # items that still have none are listed at the end, apart from the items whose request failed
+    not_converged = []
+    failed = {}  # Error kind -> ids
+    with utils.index_jsonl_file(generation_data_path, key=id_key_name) as generation_index:
+        test_data = get_input_eval(utils.iter_jsonl_file(aux_data_path), generation_index, prompt, model, base_urls,
+                                   api_key, id_key_name)
+        unprocessed_data = utils.iter_unprocessed_data(test_data, save_path, id_key_name)
+        first = next(unprocessed_data, None)
+        if first is None:
+            print("No data left to process")
+        else:
+            unprocessed_data = itertools.chain([first], unprocessed_data)
+            if args.batch:
+                results = utils.process_data_batch_spe_model(unprocessed_data, sample_num, generation_params,
+                                                             os.path.join(output_path, "batch"),
+                                                             job_name=f"evaluation_{args.model}", backend=args.batch,
+                                                             max_workers=max_workers, return_failures=True,
+                                                             stop_when="<The End of Evaluation Result>",
+                                                             reasoning=model_info["reasoning"],
+                                                             parse=lambda responses: extract_score(responses[0]),
+                                                             max_parse_attempts=args.max_parse_attempts)
+            else:
+                results = utils.process_data_async_spe_model(unprocessed_data, sample_num, generation_params,
+                                                             max_workers=max_workers, return_failures=True,
+                                                             stop_when="<The End of Evaluation Result>",
+                                                             reasoning=model_info["reasoning"],
+                                                             parse=lambda responses: extract_score(responses[0]),
+                                                             max_parse_attempts=args.max_parse_attempts)
+            with utils.JsonlWriter(save_path, index_key=id_key_name) as f:
+                for score, obj in results:
+                    if isinstance(score, Exception):
+                        kind = getattr(score, "kind", type(score).__name__)
+                        if kind == errors.PARSE:
+                            not_converged.append(obj[id_key_name])
+                        else:
+                            failed.setdefault(kind, []).append(obj[id_key_name])
+                        continue
+                    for key in ['query_model', 'query_base_url', 'query_api_key', 'input_ques']:
+                        if key in obj:
+                            del obj[key]
+                    obj["score"] = score
+                    f.write(obj)
+
+    if len(not_converged) != 0:
+        print(f"{len(not_converged)} items still have no parsable score after {args.max_parse_attempts} attempts "
+              f"(rerun to try them again): {not_converged[:20]}{' ...' if len(not_converged) > 20 else ''}")
+    for kind, ids in failed.items():
+        print(f"{len(ids)} items failed with {kind} request errors (rerun to try them again): "
+              f"{ids[:20]}{' ...' if len(ids) > 20 else ''}")
+    if len(not_converged) == 0 and len(failed) == 0:
         print("Finished")
 
 
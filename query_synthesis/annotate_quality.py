@@ -93,32 +93,18 @@ if __name__ == "__main__":
     input_data = get_input_data(queries_data, prompts, models)
 
     # Get output
-    # Read processed unique_id
-    processed_unique_ids = set()
-    if os.path.exists(save_path):
-        with open(save_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line)
-                    unique_id = data.get('id', None)
-                    if unique_id is not None:
-                        processed_unique_ids.add(unique_id)
-                except json.JSONDecodeError:
-                    print(f"Warning: JSON decode error in line: {line}")
-
     # Filter processed data items && get LLM-generated results and save in real-time
-    unprocessed_data = [obj for obj in input_data if obj.get('id', None) not in processed_unique_ids]
+    unprocessed_data = utils.filter_processed_data(input_data, save_path)
     print("Remaining unprocessed data volume:", len(unprocessed_data))
     if len(unprocessed_data) != 0:
-        with open(save_path, 'a', encoding='utf-8') as f:
-            for responses, obj in utils.process_data_async_spe_model(unprocessed_data, sample_num, generation_params):
-                question_quality = parse_label_string(responses[0])
+        with utils.JsonlWriter(save_path) as f:
+            # Labels that cannot be parsed are asked again right away
+            for question_quality, obj in utils.process_data_async_spe_model(
+                    unprocessed_data, sample_num, generation_params,
+                    parse=lambda responses: parse_label_string(responses[0]) or None):
                 obj["meta_data"]["question_quality"] = question_quality.get("question_quality", [])
                 del obj["input_ques"]
                 del obj["query_model"]
                 del obj["query_base_url"]
                 del obj["query_api_key"]
-                if not question_quality:
-                    continue
-                f.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                f.flush()
+                f.write(obj)
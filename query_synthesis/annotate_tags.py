@@ -120,29 +120,15 @@ if __name__ == "__main__":
     input_data = get_input_data(queries_data, prompts, models)
 
     # Get output
-    # Read processed unique_id
-    processed_unique_ids = set()
-    if os.path.exists(save_path):
-        with open(save_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line)
-                    unique_id = data.get('id', None)
-                    if unique_id is not None:
-                        processed_unique_ids.add(unique_id)
-                except json.JSONDecodeError:
-                    print(f"Warning: JSON decode error in line: {line}")
-
     # Filter processed data items && get LLM-generated results and save in real-time
-    unprocessed_data = [obj for obj in input_data if obj.get('id', None) not in processed_unique_ids]
+    unprocessed_data = utils.filter_processed_data(input_data, save_path)
     print("Remaining unprocessed data volume:", len(unprocessed_data))
     if len(unprocessed_data) != 0:
-        with open(save_path, 'a', encoding='utf-8') as f:
-            for responses, obj in utils.process_data_async_spe_model(unprocessed_data, sample_num, generation_params):
-                type_tags = parse_label_string(responses[0])
-                if not type_tags:
-                    continue
-
+        with utils.JsonlWriter(save_path) as f:
+            # Tags that cannot be parsed are asked again right away
+            for type_tags, obj in utils.process_data_async_spe_model(
+                    unprocessed_data, sample_num, generation_params,
+                    parse=lambda responses: parse_label_string(responses[0]) or None):
                 type_tags = filter_type_tags(type_tags, allowed_tags)
                 obj["meta_data"]["type_tags"] = type_tags
                 del obj["input_ques"]
@@ -150,5 +136,4 @@ if __name__ == "__main__":
                 del obj["query_base_url"]
                 del obj["query_api_key"]
 
-                f.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                f.flush()
+                f.write(obj)
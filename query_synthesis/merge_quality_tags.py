@@ -12,16 +12,16 @@ data1_path = os.path.join(output_path, "generated_queries_with_quality.jsonl")
 data2_path = os.path.join(output_path, "generated_queries_with_tags.jsonl")
 save_path = os.path.join(output_path, "generated_queries_with_quality_tags.jsonl")
 
-data1 = utils.read_jsonl_file(data1_path)
-data2 = utils.read_jsonl_file(data2_path)
+# Stream the quality file and look the tags up by id instead of scanning the tags file for every record
+tags_index = utils.index_jsonl_file(data2_path)
 
 merged_data = []
-for obj in data1:
-    for obj2 in data2:
-        if obj['id'] == obj2['id']:
-            obj["meta_data"]["type_tags"] = obj2["meta_data"]["type_tags"]
-            merged_data.append(obj)
-            break
+for obj in utils.iter_jsonl_file(data1_path):
+    obj2 = tags_index.get(obj['id'])
+    if obj2 is not None:
+        obj["meta_data"]["type_tags"] = obj2["meta_data"]["type_tags"]
+        merged_data.append(obj)
+tags_index.close()
 
 # Save the merged data
 utils.write_jsonl_file(merged_data, save_path)
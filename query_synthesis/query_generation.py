@@ -78,10 +78,22 @@ def parse_label_string(label_str):
         return {}
 
 
+def first_new_query(responses):
+    for response in responses:
+        new_query = (parse_label_string(response) or "").strip()
+        if new_query:
+            return new_query
+    return None
+
+
 if __name__ == "__main__":
     # Input parameters
     parser = argparse.ArgumentParser()
     parser.add_argument('--domain', type=str, default="roleplay", help='domain name')
+    parser.add_argument('--sample_num', type=int, default=1, help='Number of candidate queries to sample per item')
+    parser.add_argument('--use_n', action='store_true',
+                        help='Ask for all sample_num candidates in one request with `n` (if the endpoint supports it); '
+                             'answers are then not streamed and cut off at </new_query>')
     args = parser.parse_args()
 
     # Set fixed global random seed (this needs to be modified)
@@ -92,7 +104,7 @@ if __name__ == "__main__":
     generation_params = {}
     output_path = "outputs/"
     os.makedirs(output_path, exist_ok=True)
-    sample_num = 1
+    sample_num = args.sample_num
 
     models = [{"query_model": "gpt-4.1", "query_base_url": 'http://localhost:8006/', "query_api_key": "any"},
               {"query_model": "deepseek-v3", "query_base_url": 'http://localhost:8006/', "query_api_key": "any"},
@@ -118,33 +130,18 @@ if __name__ == "__main__":
     input_data = get_input_data(sampled_data, args.domain, prompt, models)
 
     # Get output
-    # Read processed unique_id
-    processed_unique_ids = set()
-    if os.path.exists(save_path):
-        with open(save_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    data = json.loads(line)
-                    unique_id = data.get('id', None)
-                    if unique_id is not None:
-                        processed_unique_ids.add(unique_id)
-                except json.JSONDecodeError:
-                    print(f"Warning: JSON decode error in line: {line}")
-
     # Filter processed data items && get LLM-generated results and save in real-time
-    unprocessed_data = [obj for obj in input_data if obj.get('id', None) not in processed_unique_ids]
+    unprocessed_data = utils.filter_processed_data(input_data, save_path)
     print("Remaining unprocessed data volume:", len(unprocessed_data))
     if len(unprocessed_data) != 0:
-        with open(save_path, 'a', encoding='utf-8') as f:
-            for responses, obj in utils.process_data_async_spe_model(unprocessed_data, sample_num, generation_params):
-                prompt = parse_label_string(responses[0])
-                prompt = prompt.strip()
+        with utils.JsonlWriter(save_path) as f:
+            # The first candidate with a usable <new_query> is kept; if there is none, the item is asked again right away
+            for prompt, obj in utils.process_data_async_spe_model(
+                    unprocessed_data, sample_num, generation_params, use_n=args.use_n,
+                    stop_when=None if args.use_n else ["</new_query>", "<\\new_query>"], parse=first_new_query):
                 obj["prompt"] = prompt
                 del obj["input_ques"]
                 del obj["query_model"]
                 del obj["query_base_url"]
                 del obj["query_api_key"]
-                if not prompt:
-                    continue
-                f.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                f.flush()
+                f.write(obj)
@@ -90,32 +90,25 @@ def find_node_llm_decision(current_keys, new_node, max_retries, base_url, api_ke
         "current_keys": current_keys,
         "input_ques": [{"role": "user", "content": base_prompt.format(current_keys=current_keys, new_node=new_node)}]
     }
-    unprocessed_data = [obj]
-    decision = None
-    i = 0
-    while True:
-        for responses, obj in utils.process_data_async(unprocessed_data, model, sample_num, base_url, api_key,
-                                                       generation_params):
-            try:
-                decision = parse_label_string(responses[0])
-                if decision not in current_keys + ["ADD", "EXIST"]:
-                    raise ValueError(f"Invalid decision: {decision}")
-                obj["raw_output"] = responses[0]
-                obj["decision"] = decision
-                file.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                file.flush()
-                break
-            except Exception as e:
-                if i + 1 == max_retries:
-                    obj["raw_output"] = responses[0]
-                    obj["decision"] = "Exceeded maximum retry limit, skipping this node"
-                    file.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                    file.flush()
-                    return "Exceeded maximum retry limit, skipping this node"
-        if decision:
-            break
-        i += 1
-    return decision
+
+    def parse(responses):
+        decision = parse_label_string(responses[0])
+        if decision not in current_keys + ["ADD", "EXIST"]:
+            raise ValueError(f"Invalid decision: {decision}")
+        return decision, responses[0]
+
+    for result, obj in utils.process_data_async([obj], model, sample_num, base_url, api_key, generation_params,
+                                                stop_when="</decision>", parse=parse, max_parse_attempts=max_retries,
+                                                return_failures=True):
+        if isinstance(result, Exception):
+            responses = getattr(result.error, "responses", None)
+            obj["raw_output"] = responses[0] if responses else str(result)
+            obj["decision"] = "Exceeded maximum retry limit, skipping this node"
+        else:
+            obj["decision"], obj["raw_output"] = result
+        file.write(json.dumps(obj, ensure_ascii=False) + '\n')
+        file.flush()
+    return obj["decision"]
 
 
 if __name__ == "__main__":
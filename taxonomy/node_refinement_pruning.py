@@ -146,54 +146,46 @@ def pruning_node_llm_decision(current_keys, leaf_keys, max_retries, base_url, ap
         "leaf_keys": leaf_keys,
         "input_ques": [{"role": "user", "content": base_prompt.format(current_keys=current_keys, leaf_keys=leaf_keys)}]
     }
-    unprocessed_data = [obj] * 1
-    decision = None
-    i = 0
-    while True:
-        for responses, obj in utils.process_data_async(unprocessed_data, model, sample_num, base_url, api_key,
-                                                       generation_params):
-            try:
-                decision = parse_label_string(responses[0])
-
-                # Try to decode and raise if any issues
-                decision_dict = ast.literal_eval(decision)
-                for op_type, items in decision_dict.items():
-                    if op_type == "keep":
-                        for old_key in items:
-                            if old_key not in current_keys:
-                                raise ValueError(f"{old_key} not in {current_keys}")
-                    elif op_type == "merge":
-                        for new_key, keys_to_merge in items:
-                            for old_key in keys_to_merge:
-                                if old_key not in current_keys:
-                                    raise ValueError(f"{old_key} not in {current_keys}")
-                    elif op_type == "split":
-                        for old_key, sub_items in items:
-                            if old_key not in leaf_keys:
-                                raise ValueError(f"{old_key} not in {current_keys}")
-                    elif op_type == "reparent":
-                        for parent_key, child_keys in items:
-                            for old_key in child_keys:
-                                if old_key not in current_keys:
-                                    raise ValueError(f"{old_key} not in {current_keys}")
-
-                print("decision", decision)
-                obj["raw_output"] = responses[0]
-                obj["decision"] = decision
-                file.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                file.flush()
-                return decision
-            except Exception as e:
-                print(e)
-                if i + 1 >= max_retries:
-                    obj["raw_output"] = responses[0]
-                    obj["decision"] = "Exceeded max retry limit, abort modification"
-                    print("Exceeded max retry limit, abort modification")
-                    file.write(json.dumps(obj, ensure_ascii=False) + '\n')
-                    file.flush()
-                    return obj["decision"]
-        i += 1
-        print("Retry", i)
+
+    def parse(responses):
+        decision = parse_label_string(responses[0])
+
+        # Try to decode and raise if any issues
+        decision_dict = ast.literal_eval(decision)
+        for op_type, items in decision_dict.items():
+            if op_type == "keep":
+                for old_key in items:
+                    if old_key not in current_keys:
+                        raise ValueError(f"{old_key} not in {current_keys}")
+            elif op_type == "merge":
+                for new_key, keys_to_merge in items:
+                    for old_key in keys_to_merge:
+                        if old_key not in current_keys:
+                            raise ValueError(f"{old_key} not in {current_keys}")
+            elif op_type == "split":
+                for old_key, sub_items in items:
+                    if old_key not in leaf_keys:
+                        raise ValueError(f"{old_key} not in {current_keys}")
+            elif op_type == "reparent":
+                for parent_key, child_keys in items:
+                    for old_key in child_keys:
+                        if old_key not in current_keys:
+                            raise ValueError(f"{old_key} not in {current_keys}")
+        return decision, responses[0]
+
+    for result, obj in utils.process_data_async([obj], model, sample_num, base_url, api_key, generation_params,
+                                                parse=parse, max_parse_attempts=max_retries, return_failures=True):
+        if isinstance(result, Exception):
+            responses = getattr(result.error, "responses", None)
+            obj["raw_output"] = responses[0] if responses else str(result)
+            obj["decision"] = "Exceeded max retry limit, abort modification"
+            print("Exceeded max retry limit, abort modification")
+        else:
+            obj["decision"], obj["raw_output"] = result
+            print("decision", obj["decision"])
+        file.write(json.dumps(obj, ensure_ascii=False) + '\n')
+        file.flush()
+    return obj["decision"]
 
 
 if __name__ == "__main__":
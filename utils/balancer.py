@@ -0,0 +1,123 @@
+import random
+import time
+from utils.concurrency import is_overload_error
+from utils.errors import CircuitOpenError
+
+
+class _Endpoint(object):
+    def __init__(self):
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.consecutive_failures = 0
+        self.ejected_at = 0.0
+        self.ejected_until = 0.0
+        self.ejection_seconds = 0.0
+        self.probing = False
+        self.num_requests = 0
+        self.num_failures = 0
+        self.num_ejections = 0
+        # Endpoints it has been a candidate together with, i.e. that can take over its requests
+        self.peers = set()
+
+
+class LoadBalancer(object):
+    """
+    Chooses a base_url for every request at dispatch time instead of pinning items to a random replica.
+
+    Each endpoint is scored by (outstanding requests + 1) * smoothed latency, so requests go to the replica
+    expected to answer first. Each endpoint also has a circuit breaker: after ``eject_after`` consecutive
+    5xx/timeout/connection failures it is ejected (circuit open) for ``eject_seconds``, then re-admitted with a single
+    probe request in flight (half open). A probe failure ejects it again for twice as long (up to
+    ``max_eject_seconds``); a success closes the circuit. 429s are left to the AIMD limits and the rate limiter: a
+    rate-limited endpoint is busy, not broken. The last endpoint still admitted among its peers is never ejected,
+    so a single backend is throttled rather than shut off. While no candidate admits requests (a probe is in
+    flight), CircuitOpenError is raised instead of sending the request.
+    """
+
+    def __init__(self, eject_after=3, eject_seconds=10.0, max_eject_seconds=300.0, latency_smoothing=0.2):
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.latency_smoothing = latency_smoothing
+        self.endpoints = {}
+
+    def _endpoint(self, base_url):
+        endpoint = self.endpoints.get(base_url)
+        if endpoint is None:
+            endpoint = _Endpoint()
+            self.endpoints[base_url] = endpoint
+        return endpoint
+
+    def _admits(self, endpoint, now):
+        if endpoint.ejected_until > now:
+            return False
+        # Re-admitted but not recovered yet: one probe at a time
+        return endpoint.ejection_seconds == 0 or not endpoint.probing
+
+    def choose(self, base_urls):
+        candidates = [base_urls] if isinstance(base_urls, str) else list(dict.fromkeys(base_urls))
+        for url in candidates:
+            self._endpoint(url).peers.update(candidates)
+        now = time.monotonic()
+        healthy = [url for url in candidates if self._admits(self._endpoint(url), now)]
+        if not healthy:
+            retry_in = max(0.0, min(self._endpoint(url).ejected_until for url in candidates) - now)
+            raise CircuitOpenError(f"Circuit open for {', '.join(candidates)}, retry in {retry_in:.0f}s",
+                                   retry_in=retry_in)
+        if len(healthy) == 1:
+            return healthy[0]
+        # Endpoints without a latency sample yet score 0, so every replica gets probed early on
+        scores = {url: (self._endpoint(url).outstanding + 1) * (self._endpoint(url).ewma_latency or 0.0)
+                  for url in healthy}
+        best = min(scores.values())
+        return random.choice([url for url in healthy if scores[url] == best])
+
+    def start(self, base_url):
+        endpoint = self._endpoint(base_url)
+        endpoint.outstanding += 1
+        endpoint.num_requests += 1
+        if endpoint.ejection_seconds > 0:
+            endpoint.probing = True
+        return time.monotonic()
+
+    def finish(self, base_url, start_time, error=None):
+        endpoint = self._endpoint(base_url)
+        endpoint.outstanding -= 1
+        endpoint.probing = False
+        if error is None:
+            latency = time.monotonic() - start_time
+            if endpoint.ewma_latency is None:
+                endpoint.ewma_latency = latency
+            else:
+                endpoint.ewma_latency += self.latency_smoothing * (latency - endpoint.ewma_latency)
+            endpoint.consecutive_failures = 0
+            endpoint.ejection_seconds = 0.0
+        elif is_overload_error(error):
+            endpoint.num_failures += 1
+            if getattr(error, "status_code", None) == 429 or start_time < endpoint.ejected_at:
+                # Rate limited, or sent before the last ejection: no news about the endpoint's health
+                return
+            endpoint.consecutive_failures += 1
+            # A re-admitted endpoint that has not succeeded yet is ejected again on its first failure
+            threshold = 1 if endpoint.ejection_seconds > 0 else self.eject_after
+            if endpoint.consecutive_failures >= threshold and self._has_healthy_peer(base_url):
+                endpoint.ejection_seconds = min(self.max_eject_seconds,
+                                                max(self.eject_seconds, 2 * endpoint.ejection_seconds))
+                endpoint.ejected_at = time.monotonic()
+                endpoint.ejected_until = endpoint.ejected_at + endpoint.ejection_seconds
+                endpoint.consecutive_failures = 0
+                endpoint.num_ejections += 1
+                print(f"Ejecting {base_url} for {endpoint.ejection_seconds:.0f}s after repeated failures")
+
+    def _has_healthy_peer(self, base_url):
+        now = time.monotonic()
+        peers = self._endpoint(base_url).peers - {base_url}
+        return any(self._endpoint(url).ejected_until <= now for url in peers)
+
+    def report(self):
+        if len(self.endpoints) < 2 and not any(endpoint.num_ejections for endpoint in self.endpoints.values()):
+            return
+        for base_url, endpoint in self.endpoints.items():
+            latency = f"{endpoint.ewma_latency:.2f}s" if endpoint.ewma_latency is not None else "n/a"
+            print(f"Load balancing for {base_url}: {endpoint.num_requests} requests, {endpoint.num_failures} failed, "
+                  f"ejected {endpoint.num_ejections} times, smoothed latency {latency}")
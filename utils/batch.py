@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import uuid
+from utils import cache, clients
+
+# Batch statuses after which the output will not change any more
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def custom_id(model, messages, generation_params, attempt=1):
+    """
+    Content address of a request, so that identical requests are sent once and results survive reruns. A re-ask
+    (attempt > 1) gets an id of its own instead of the result of the rejected first answer.
+    """
+    if attempt != 1:
+        generation_params = dict(generation_params, attempt=attempt)
+    return cache.cache_key(model, messages, generation_params)[:32]
+
+
+def request_line(request_id, model, messages, generation_params):
+    # One line of a batch input file in the OpenAI batch format
+    return {"custom_id": request_id, "method": "POST", "url": BATCH_ENDPOINT,
+            "body": dict(generation_params, model=model, messages=messages)}
+
+
+def output_contents(record):
+    """Response texts of a successful batch output line, ordered by choice index; None for a failed line."""
+    response = record.get("response") or {}
+    if record.get("error") or response.get("status_code") != 200:
+        return None
+    choices = sorted(response["body"]["choices"], key=lambda choice: choice.get("index", 0))
+    return [choice["message"]["content"] for choice in choices]
+
+
+def output_error(record):
+    error = record.get("error") or ((record.get("response") or {}).get("body") or {}).get("error") or {}
+    status_code = (record.get("response") or {}).get("status_code")
+    return f"{error.get('code') or status_code}: {error.get('message') or error}"
+
+
+class OpenAIBatchBackend(object):
+    """The Batch API of OpenAI (or any server implementing /files and /batches)."""
+
+    name = "openai"
+
+    def __init__(self, base_url, api_key):
+        self.client = clients.get_client(base_url, api_key)
+
+    def submit(self, requests_path, metadata=None):
+        with open(requests_path, 'rb') as file:
+            input_file = self.client.files.create(file=file, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                           completion_window="24h", metadata=metadata)
+        return batch.id
+
+    def status(self, batch_id):
+        """Returns (status, finished requests, total requests)."""
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        if counts is None:
+            return batch.status, 0, None
+        return batch.status, counts.completed + counts.failed, counts.total
+
+    def results(self, batch_id):
+        # Output lines first, then the lines of requests that failed
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                for line in self.client.files.content(file_id).text.splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+
+
+class LocalBatchBackend(object):
+    """
+    Local stand-in for a batch API, for OpenAI-compatible servers without one (e.g. vLLM): a submitted requests file
+    is run through the request engine on a background thread, writing batch-format output lines to
+    ``<work_dir>/<batch_id>.output.jsonl`` as they finish.
+
+    Jobs do not outlive the process; a job of an earlier run reports "expired" and its partial output can still be
+    collected, so only the remaining requests have to be resubmitted.
+    """
+
+    name = "local"
+
+    def __init__(self, work_dir, base_url, api_key, process_fn, max_workers=32, **options):
+        self.work_dir = work_dir
+        self.base_url = base_url
+        self.api_key = api_key
+        # process_data_async_spe_model, passed in to avoid a circular import
+        self.process_fn = process_fn
+        self.max_workers = max_workers
+        self.options = options
+        self.jobs = {}
+
+    def _output_path(self, batch_id):
+        return os.path.join(self.work_dir, f"{batch_id}.output.jsonl")
+
+    def submit(self, requests_path, metadata=None):
+        batch_id = f"local_batch_{uuid.uuid4().hex[:16]}"
+        with open(requests_path, 'r', encoding='utf-8') as file:
+            requests = [json.loads(line) for line in file if line.strip()]
+        job = {"status": "in_progress", "finished": 0, "total": len(requests)}
+        self.jobs[batch_id] = job
+        thread = threading.Thread(target=self._run, args=(batch_id, requests, job), name="local-batch", daemon=True)
+        thread.start()
+        return batch_id
+
+    def _run(self, batch_id, requests, job):
+        from utils.utils import JsonlWriter
+        try:
+            if not requests:
+                job["status"] = "completed"
+                return
+            # Every line of one submitted file shares the model and generation params
+            body = requests[0]["body"]
+            generation_params = {key: value for key, value in body.items() if key not in ("model", "messages", "n")}
+            sample_num = body.get("n") or 1
+            items = [{"custom_id": request["custom_id"], "input_ques": request["body"]["messages"],
+                      "query_model": request["body"]["model"], "query_base_url": self.base_url,
+                      "query_api_key": self.api_key, "query_attempt": self._attempt(request)} for request in requests]
+            with JsonlWriter(self._output_path(batch_id), index_key="custom_id") as writer:
+                for responses, obj in self.process_fn(items, sample_num, generation_params,
+                                                      max_workers=self.max_workers, return_failures=True,
+                                                      **self.options):
+                    writer.write(self._output_record(obj, responses))
+                    job["finished"] += 1
+            job["status"] = "completed"
+        except Exception as e:
+            print(f"Local batch {batch_id} failed: {e}")
+            job["status"] = "failed"
+
+    @staticmethod
+    def _attempt(request):
+        # Re-asks are the requests whose custom_id is not their plain content address; the id then keeps them away
+        # from the response cached for the first ask
+        body = request["body"]
+        params = {key: value for key, value in body.items() if key not in ("model", "messages")}
+        if request["custom_id"] == custom_id(body["model"], body["messages"], params):
+            return 1
+        return request["custom_id"]
+
+    @staticmethod
+    def _output_record(obj, responses):
+        record = {"id": f"batch_req_{uuid.uuid4().hex[:16]}", "custom_id": obj["custom_id"]}
+        if isinstance(responses, Exception):
+            status_code = getattr(responses, "status_code", None) or 500
+            error = {"code": getattr(responses, "kind", type(responses).__name__), "message": str(responses)}
+            record.update(response={"status_code": status_code, "body": {"error": error}}, error=error)
+            return record
+        body = {"object": "chat.completion", "model": obj["query_model"],
+                "choices": [{"index": i, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"} for i, content in enumerate(responses)]}
+        record.update(response={"status_code": 200, "body": body}, error=None)
+        return record
+
+    def status(self, batch_id):
+        job = self.jobs.get(batch_id)
+        if job is None:
+            return "expired", 0, None
+        return job["status"], job["finished"], job["total"]
+
+    def results(self, batch_id):
+        path = self._output_path(batch_id)
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def load_state(path):
+    # Batches submitted for a job: [{"batch_id", "backend", "model", "base_url", "num_requests", "merged"}]
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_state(path, state):
+    with open(path + ".tmp", 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=2)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def cache_key(model, messages, generation_params, sample_index=0):
+    """Content address of a request: hash of model, messages, generation params and the sample index."""
+    payload = json.dumps({"model": model, "messages": messages, "params": generation_params,
+                          "sample_index": sample_index}, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    Persistent SQLite cache of chat completions, keyed by cache_key.
+
+    Entries are evicted least-recently-used first once the stored responses exceed ``max_size_mb``. Access times of
+    hits are written in batches (with the next put, every 256 hits, or on flush()), not one commit per hit.
+    In ``read_only`` mode hits are served but nothing is written, not even access times.
+    """
+
+    def __init__(self, path, max_size_mb=1024, read_only=False):
+        self.path = path
+        self.max_bytes = None if max_size_mb is None else int(max_size_mb * 1024 * 1024)
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched = {}  # key -> access time of hits not written yet
+        if read_only:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                               "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._touched[key] = time.time()
+                if len(self._touched) >= 256:
+                    self._write_touched()
+                    self._conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        if self.read_only:
+            return
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                               (key, value, size, time.time()))
+            self._size += size - (old[0] if old else 0)
+            self._write_touched()
+            if self.max_bytes is not None and self._size > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def delete(self, key):
+        if self.read_only:
+            return
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= row[0]
+                self._conn.commit()
+
+    def flush(self):
+        if self.read_only:
+            return
+        with self._lock:
+            self._write_touched()
+            self._conn.commit()
+
+    def _write_touched(self):
+        if self._touched:
+            self._conn.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                   [(access_time, key) for key, access_time in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self):
+        # Drop the least recently used entries until 90% of the budget is left, to avoid evicting on every put
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access")
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def report(self, since=(0, 0)):
+        # since: (hits, misses) at the start of the period being reported
+        hits, misses = self.hits - since[0], self.misses - since[1]
+        if hits or misses:
+            print(f"Response cache {self.path}: {hits} hits, {misses} misses")
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+_response_cache = None
+
+
+def enable_response_cache(path, max_size_mb=1024, read_only=False):
+    """Opt in to the on-disk response cache for every LLM call of this process."""
+    global _response_cache
+    _response_cache = ResponseCache(path, max_size_mb=max_size_mb, read_only=read_only)
+    return _response_cache
+
+
+def get_response_cache():
+    # Scripts can also be opted in without code changes through FEEDBACKER_RESPONSE_CACHE (path),
+    # FEEDBACKER_RESPONSE_CACHE_MAX_MB and FEEDBACKER_RESPONSE_CACHE_READ_ONLY=1
+    global _response_cache
+    if _response_cache is None and os.environ.get("FEEDBACKER_RESPONSE_CACHE"):
+        enable_response_cache(os.environ["FEEDBACKER_RESPONSE_CACHE"],
+                              max_size_mb=float(os.environ.get("FEEDBACKER_RESPONSE_CACHE_MAX_MB", 1024)),
+                              read_only=os.environ.get("FEEDBACKER_RESPONSE_CACHE_READ_ONLY") == "1")
+    return _response_cache
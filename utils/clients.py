@@ -0,0 +1,103 @@
+import atexit
+import threading
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from utils import telemetry
+
+# Process-wide registries keyed by (base_url, api_key), so that every request to the same endpoint reuses
+# one connection pool with keep-alive instead of paying a new client setup and TCP/TLS handshake per item.
+_sync_clients = {}
+_sync_lock = threading.Lock()
+# (base_url, api_key) -> [AsyncOpenAI, number of runs using it]; only touched from the request engine's loop
+_async_clients = {}
+# Retries are done by the request layer (utils._RunState), so that every 429/5xx is visible to the concurrency control
+CLIENT_MAX_RETRIES = 0
+
+
+def _http2_available(http2):
+    if not http2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("HTTP/2 requested but the 'h2' package is not installed, falling back to HTTP/1.1")
+        return False
+    return True
+
+
+def pool_limits(max_workers):
+    """Connection pool limits sized so that max_workers requests in flight never wait for a connection."""
+    return httpx.Limits(max_connections=max_workers, max_keepalive_connections=max_workers, keepalive_expiry=60)
+
+
+def get_client(base_url, api_key, max_workers=32, http2=False):
+    """Return the shared synchronous client for an endpoint, creating it on first use."""
+    key = (base_url, api_key)
+    with _sync_lock:
+        client = _sync_clients.get(key)
+        if client is None:
+            http_client = DefaultHttpxClient(limits=pool_limits(max_workers), http2=_http2_available(http2))
+            client = OpenAI(base_url=base_url, api_key=api_key, http_client=http_client,
+                            max_retries=CLIENT_MAX_RETRIES)
+            _sync_clients[key] = client
+    return client
+
+
+def close_clients():
+    with _sync_lock:
+        for client in _sync_clients.values():
+            client.close()
+        _sync_clients.clear()
+
+
+atexit.register(close_clients)
+
+
+def acquire_async_client(base_url, api_key, max_workers=32, http2=False):
+    """Borrow the shared asynchronous client for an endpoint. Must be called on the request engine's loop."""
+    key = (base_url, api_key)
+    entry = _async_clients.get(key)
+    if entry is None:
+        # The response hook timestamps the first byte of each request for the run's telemetry
+        http_client = DefaultAsyncHttpxClient(limits=pool_limits(max_workers), http2=_http2_available(http2),
+                                              event_hooks={"response": [telemetry.on_response]})
+        client = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client,
+                             max_retries=CLIENT_MAX_RETRIES)
+        entry = [client, 0]
+        _async_clients[key] = entry
+    entry[1] += 1
+    return entry[0]
+
+
+async def release_async_client(base_url, api_key):
+    """Give back a borrowed client; the last run using an endpoint closes its connections."""
+    key = (base_url, api_key)
+    entry = _async_clients.get(key)
+    if entry is None:
+        return
+    entry[1] -= 1
+    if entry[1] <= 0:
+        del _async_clients[key]
+        await entry[0].close()
+
+
+class AsyncClientLease(object):
+    """The asynchronous clients borrowed by one run of the request engine."""
+
+    def __init__(self, max_workers=32, http2=False):
+        self.max_workers = max_workers
+        self.http2 = http2
+        self.clients = {}
+
+    def get(self, base_url, api_key):
+        key = (base_url, api_key)
+        client = self.clients.get(key)
+        if client is None:
+            client = acquire_async_client(base_url, api_key, self.max_workers, self.http2)
+            self.clients[key] = client
+        return client
+
+    async def aclose(self):
+        for base_url, api_key in list(self.clients):
+            await release_async_client(base_url, api_key)
+        self.clients.clear()
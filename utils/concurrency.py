@@ -0,0 +1,127 @@
+import asyncio
+import time
+import openai
+
+
+def is_overload_error(e):
+    """Whether an exception means the endpoint is overloaded: 429, 5xx, timeouts and dropped connections."""
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    status_code = getattr(e, "status_code", None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+class AIMDLimiter(object):
+    """
+    In-flight request limit for one endpoint, adjusted with additive increase / multiplicative decrease.
+
+    The limit starts in slow start (doubling every window of successful requests) until the first congestion
+    signal, then grows by one per window while the endpoint is healthy. A 429, 5xx, timeout, or a smoothed
+    latency above ``latency_tolerance`` times the best smoothed latency seen so far multiplies it by ``decrease``,
+    at most once per round trip.
+    """
+
+    def __init__(self, max_limit, initial_limit=8, min_limit=1, decrease=0.5, latency_tolerance=3.0,
+                 latency_smoothing=0.1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(max(self.min_limit, min(initial_limit, self.max_limit)))
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.latency_smoothing = latency_smoothing
+        self.slow_start = True
+        self.in_flight = 0
+        self.ewma_latency = None
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self.num_success = 0
+        self.num_overload = 0
+        self._condition = None
+
+    @property
+    def current_limit(self):
+        return max(self.min_limit, int(self.limit))
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.current_limit)
+            self.in_flight += 1
+
+    async def release(self, latency, error=None):
+        self.in_flight -= 1
+        if error is None:
+            self._on_success(latency)
+        elif is_overload_error(error):
+            self.num_overload += 1
+            self._back_off()
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _on_success(self, latency):
+        self.num_success += 1
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency += self.latency_smoothing * (latency - self.ewma_latency)
+        if self.best_latency is None or self.ewma_latency < self.best_latency:
+            self.best_latency = self.ewma_latency
+        if (self.latency_tolerance is not None and self.num_success > self.current_limit
+                and self.ewma_latency > self.latency_tolerance * self.best_latency):
+            self._back_off()
+        elif self.slow_start:
+            self.limit = min(self.max_limit, self.limit + 1)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _back_off(self):
+        now = time.monotonic()
+        # Requests already in flight when we backed off report the same congestion; react once per round trip
+        if now - self.last_decrease < (self.ewma_latency or 0):
+            return
+        self.last_decrease = now
+        self.slow_start = False
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+
+    def slot(self):
+        """Async context manager holding one in-flight slot and reporting its latency and outcome."""
+        return _Slot(self)
+
+
+class _Slot(object):
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.start = None
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.start = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.limiter.release(time.monotonic() - self.start, exc)
+        return False
+
+
+class ConcurrencyController(object):
+    """One AIMDLimiter per base_url, created on first use, for the duration of a run."""
+
+    def __init__(self, max_workers, **limiter_kwargs):
+        self.max_workers = max_workers
+        self.limiter_kwargs = limiter_kwargs
+        self.limiters = {}
+
+    def get(self, base_url):
+        limiter = self.limiters.get(base_url)
+        if limiter is None:
+            limiter = AIMDLimiter(self.max_workers, **self.limiter_kwargs)
+            self.limiters[base_url] = limiter
+        return limiter
+
+    def report(self):
+        for base_url, limiter in self.limiters.items():
+            latency = f"{limiter.ewma_latency:.2f}s" if limiter.ewma_latency is not None else "n/a"
+            print(f"Concurrency for {base_url}: settled at {limiter.current_limit} in-flight requests "
+                  f"(ceiling {limiter.max_limit}, {limiter.num_success} ok, {limiter.num_overload} overloaded, "
+                  f"smoothed latency {latency})")
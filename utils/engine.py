@@ -0,0 +1,197 @@
+import asyncio
+import atexit
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+
+class _LoopThread(object):
+    """A background thread running one asyncio event loop for the whole process."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="request-engine-loop", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        if not self.loop.is_running():
+            return
+        try:
+            self.submit(_cancel_pending()).result(timeout=5)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+
+async def _cancel_pending():
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def get_loop_thread():
+    # All requests of the process share a single event loop, started lazily on first use
+    global _loop_thread
+    with _loop_lock:
+        if _loop_thread is None:
+            _loop_thread = _LoopThread()
+            atexit.register(_loop_thread.stop)
+    return _loop_thread
+
+
+def run_on_loop(coro, timeout=None):
+    """Run a coroutine on the shared event loop and wait for its result from the calling thread."""
+    return get_loop_thread().submit(coro).result(timeout)
+
+
+class SingleFlight(object):
+    """Collapses concurrent calls with the same key into one upstream call whose result all callers share."""
+
+    def __init__(self):
+        self.calls = {}
+        self.saved = 0
+
+    async def do(self, key, coro_fn):
+        future = self.calls.get(key)
+        if future is not None:
+            self.saved += 1
+            # Shielded so that a waiter being cancelled does not cancel the call the others are waiting for
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await coro_fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved, there may be no waiters
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.calls.pop(key, None)
+
+
+_DONE = object()
+
+
+class _Run(object):
+    """State shared between the driver coroutine and the consuming generator of one run."""
+
+    def __init__(self, max_workers, window):
+        self.max_workers = max_workers
+        self.window = window
+        self.results = queue.Queue()
+        self.loop = None
+        self.window_semaphore = None
+
+    def item_consumed(self):
+        # Called from the consumer thread once a result has been taken, freeing a slot of the window
+        self.loop.call_soon_threadsafe(self.window_semaphore.release)
+
+
+async def _drive(test_data, request_fn, run):
+    # Items are pulled from the input lazily: at most `window` of them are outstanding (in flight, or finished
+    # but not yet taken by the consumer), and at most `max_workers` of those are in flight
+    run.loop = asyncio.get_running_loop()
+    run.window_semaphore = asyncio.Semaphore(run.window)
+    # The input is pulled on a thread of its own: building an item (decoding, index lookups, rendering) must not hold
+    # up the loop that serves every connection
+    producer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="request-engine-input")
+    semaphore = asyncio.Semaphore(run.max_workers)
+    tasks = set()
+
+    async def run_one(obj):
+        try:
+            await semaphore.acquire()
+            try:
+                result = await request_fn(obj)
+            finally:
+                semaphore.release()
+            run.results.put((result, None, obj))
+        except Exception as e:
+            run.results.put((None, e, obj))
+
+    try:
+        iterator = iter(test_data)
+        while True:
+            # Take a window slot before pulling the next item, so that no extra item is held while waiting
+            await run.window_semaphore.acquire()
+            obj = await run.loop.run_in_executor(producer, next, iterator, _DONE)
+            if obj is _DONE:
+                break
+            task = asyncio.ensure_future(run_one(obj))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(list(tasks))
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*list(tasks), return_exceptions=True)
+        producer.shutdown(wait=False)
+        run.results.put(_DONE)
+
+
+def run_requests(test_data, request_fn, max_workers=32, window=None, total=None, return_failures=False):
+    """
+    Run the coroutine function ``request_fn(obj)`` for every item of ``test_data`` on the shared event loop.
+
+    :param test_data: Items to process, any iterable; generators are consumed lazily, on a thread of their own
+    :param request_fn: Coroutine function called with one item, returning its result
+    :param max_workers: Maximum number of requests in flight at the same time
+    :param window: Maximum number of items pulled from test_data but not yet yielded, defaults to 2 * max_workers
+    :param total: Number of items for the progress bar, taken from len(test_data) when available
+    :param return_failures: Yield (exception, obj) for failed items instead of only reporting them
+    :return: Generator of (result, obj) in completion order; failed items are reported and skipped
+    """
+    if window is None:
+        window = 2 * max_workers
+    if total is None and hasattr(test_data, "__len__"):
+        total = len(test_data)
+    run = _Run(max_workers, window)
+    results = run.results
+    future = get_loop_thread().submit(_drive(test_data, request_fn, run))
+    try:
+        with tqdm(total=total) as pbar:
+            while True:
+                item = results.get()
+                if item is _DONE:
+                    break
+                run.item_consumed()
+                result, error, obj = item
+                pbar.update(1)
+                if error is not None:
+                    print(f"Error processing item: {error}")
+                    if return_failures:
+                        yield error, obj
+                    continue
+                yield result, obj
+        # Surface errors raised while iterating the input itself
+        future.result()
+    finally:
+        # Stop outstanding requests if the caller leaves the loop early, and wait until they are cancelled
+        if not future.done():
+            future.cancel()
+            try:
+                while results.get(timeout=5) is not _DONE:
+                    pass
+            except queue.Empty:
+                pass
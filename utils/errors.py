@@ -0,0 +1,90 @@
+import asyncio
+import openai
+
+# Error classes of the request layer
+PERMANENT = "permanent"  # Retrying cannot help: malformed request, context length exceeded, auth, unknown model
+TRANSIENT = "transient"  # Worth retrying: 429, 5xx, timeouts, dropped connections
+CIRCUIT_OPEN = "circuit_open"  # Not sent: every endpoint for the request is failing
+PARSE = "parse"  # Answered, but the caller's parse callback rejected every attempt
+
+# Attempts per request before giving up on transient errors (was 99999); with up to 60 s between attempts this
+# still rides out several minutes of endpoint trouble
+MAX_ATTEMPTS = 10
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit of every candidate endpoint is open."""
+
+    def __init__(self, message, retry_in=0.0):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class ParseError(ValueError):
+    """An answer rejected by the parse callback of process_data_async; keeps the responses for the caller."""
+
+    def __init__(self, message, responses=None):
+        super().__init__(message)
+        self.responses = responses
+
+
+class RequestFailed(Exception):
+    """Structured failure of one request, returned to callers instead of the responses."""
+
+    def __init__(self, error, kind, attempts, base_url=None):
+        super().__init__(f"{kind} {type(error).__name__} after {attempts} attempt(s): {error}")
+        self.error = error
+        self.kind = kind
+        self.attempts = attempts
+        self.base_url = base_url
+
+    @property
+    def status_code(self):
+        return getattr(self.error, "status_code", None)
+
+    def to_dict(self):
+        return {"kind": self.kind, "error_type": type(self.error).__name__, "status_code": self.status_code,
+                "message": str(self.error)[:1000], "attempts": self.attempts, "base_url": self.base_url}
+
+
+def classify_error(e):
+    if isinstance(e, CircuitOpenError):
+        return CIRCUIT_OPEN
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError)):
+        return TRANSIENT
+    status_code = getattr(e, "status_code", None)
+    if status_code is not None:
+        # 408 Request Timeout and 409 Conflict are retried by the OpenAI SDK as well
+        if status_code in (408, 409, 429) or status_code >= 500:
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(e, (TypeError, ValueError)):
+        # Raised by the client before sending, e.g. invalid generation params
+        return PERMANENT
+    return TRANSIENT
+
+
+def is_retryable(e):
+    return classify_error(e) != PERMANENT
+
+
+class RetryBudget(object):
+    """
+    Per-run retry budget: every request deposits ``ratio`` of a retry and every retry withdraws one, on top of
+    ``min_retries``. Once spent, transient errors fail fast instead of piling retries onto a struggling endpoint.
+    """
+
+    def __init__(self, ratio=0.2, min_retries=100):
+        self.balance = float(min_retries)
+        self.ratio = ratio
+        self.exhausted = 0
+
+    def deposit(self):
+        self.balance += self.ratio
+
+    def withdraw(self):
+        if self.balance >= 1:
+            self.balance -= 1
+            return True
+        self.exhausted += 1
+        return False
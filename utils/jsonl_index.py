@@ -0,0 +1,199 @@
+import hashlib
+import json
+import mmap
+import os
+
+try:
+    import orjson  # Optional, several times faster than json for decoding large JSONL files
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """Decode one JSON line with orjson when installed, falling back to json for what orjson rejects."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects the NaN / Infinity literals json.dumps writes by default
+            pass
+    return json.loads(data)
+
+
+class JsonlIndex(object):
+    """
+    Persistent id -> byte-offset index of a JSONL file, stored next to it as ``<file>.idx``.
+
+    The sidecar holds one ``offset<TAB>length<TAB>json-encoded id`` line per record, and ``<file>.idx.meta``
+    records how many bytes of the data file are indexed, with the file's inode, mtime and a hash of the first and
+    last bytes of the indexed region. When the data file has only grown (stage outputs are appended to), opening the
+    index parses just the new tail; if it was truncated, replaced or rewritten, the index is rebuilt. Records are
+    read through a memory map, so a lookup decodes only the requested line, and a line whose id is not the one
+    asked for (the file was edited in place behind the index's back) also triggers a rebuild.
+
+    Like the nested-loop joins it replaces, the first record with a given id wins. JsonlWriter keeps the index of
+    the file it writes up to date through add(), which is what makes it usable as the resume ledger.
+    """
+
+    def __init__(self, file_path, key="id"):
+        self.file_path = str(file_path)
+        self.key = key
+        # Indexes on other keys live side by side, e.g. <file>.question_id.idx
+        self.index_path = self.file_path + (".idx" if key == "id" else f".{key}.idx")
+        self.meta_path = self.index_path + ".meta"
+        self.offsets = {}
+        self._indexed_size = 0
+        self._file = None
+        self._mmap = None
+        self._load()
+        self.refresh()
+
+    def _fingerprint(self, size):
+        # Hash of the first and last bytes of the indexed region; detects a file that was rewritten rather than
+        # appended to, even when the new contents start the same way
+        digest = hashlib.sha1()
+        with open(self.file_path, 'rb') as file:
+            digest.update(file.read(min(size, 4096)))
+            file.seek(max(0, size - 4096))
+            digest.update(file.read(size - file.tell()))
+        return digest.hexdigest()
+
+    def _load(self):
+        if not (os.path.exists(self.index_path) and os.path.exists(self.meta_path)):
+            return
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return
+        stat = os.stat(self.file_path)
+        if meta.get("key") != self.key or meta.get("ino") != stat.st_ino or meta.get("size", 0) > stat.st_size:
+            return
+        # Unchanged since the index was saved, or grown: the indexed region must still hold the same bytes
+        if not (meta["size"] == stat.st_size and meta.get("mtime_ns") == stat.st_mtime_ns) and \
+                meta.get("fingerprint") != self._fingerprint(meta["size"]):
+            return
+        offsets = {}
+        with open(self.index_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                offset, length, record_id = line.rstrip("\n").split("\t", 2)
+                offsets.setdefault(loads(record_id), (int(offset), int(length)))
+        self.offsets = offsets
+        self._indexed_size = meta["size"]
+
+    def rebuild(self):
+        """Drop the index and read the whole data file again."""
+        self.offsets, self._indexed_size = {}, 0
+        return self.refresh()
+
+    def refresh(self):
+        """Index the records appended since the last call and remap the file. Returns the number of new records."""
+        if os.path.getsize(self.file_path) < self._indexed_size:
+            # Truncated: start over
+            self.offsets, self._indexed_size = {}, 0
+        new_lines = []
+        with open(self.file_path, 'rb') as file:
+            file.seek(self._indexed_size)
+            offset = self._indexed_size
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Partial last line of a file that is still being written, index it next time
+                    break
+                try:
+                    record_id = loads(line)[self.key]
+                except Exception:
+                    record_id = None
+                if record_id is not None and record_id not in self.offsets:
+                    self.offsets[record_id] = (offset, len(line))
+                    new_lines.append(f"{offset}\t{len(line)}\t{json.dumps(record_id, ensure_ascii=False)}\n")
+                offset += len(line)
+        self._save(new_lines, offset)
+        self._remap()
+        return len(new_lines)
+
+    def add(self, entries, offset):
+        """
+        Index lines a writer has just appended at byte `offset`, given as (id, length in bytes) pairs, without
+        reading them back. Falls back to refresh() if anything else was appended in between.
+        """
+        if offset != self._indexed_size:
+            self.refresh()
+            return
+        new_lines = []
+        for record_id, length in entries:
+            if record_id is not None and record_id not in self.offsets:
+                self.offsets[record_id] = (offset, length)
+                new_lines.append(f"{offset}\t{length}\t{json.dumps(record_id, ensure_ascii=False)}\n")
+            offset += length
+        self._save(new_lines, offset)
+
+    def _save(self, new_lines, indexed_size):
+        if not new_lines and indexed_size == self._indexed_size and os.path.exists(self.meta_path):
+            return
+        with open(self.index_path, 'a' if self._indexed_size > 0 else 'w', encoding='utf-8') as file:
+            file.writelines(new_lines)
+        self._indexed_size = indexed_size
+        stat = os.stat(self.file_path)
+        with open(self.meta_path, 'w', encoding='utf-8') as file:
+            json.dump({"key": self.key, "size": indexed_size, "ino": stat.st_ino, "mtime_ns": stat.st_mtime_ns,
+                       "fingerprint": self._fingerprint(indexed_size)}, file)
+
+    def _remap(self):
+        self._close_map()
+        if self._indexed_size > 0:
+            self._file = open(self.file_path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+        self._mmap = self._file = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, record_id):
+        return record_id in self.offsets
+
+    def ids(self):
+        return self.offsets.keys()
+
+    def get(self, record_id, default=None):
+        """Decode and return the record with this id, or ``default``."""
+        record = self._read(record_id)
+        if record is not None and not (isinstance(record, dict) and record.get(self.key) == record_id):
+            # The offsets no longer match the file: rebuild, then look again
+            self.rebuild()
+            record = self._read(record_id)
+        return record if isinstance(record, dict) else default
+
+    def _read(self, record_id):
+        location = self.offsets.get(record_id)
+        if location is None:
+            return None
+        offset, length = location
+        if self._mmap is None or offset + length > len(self._mmap):
+            # Appended through add() since the file was mapped
+            self._remap()
+        try:
+            return loads(self._mmap[offset:offset + length])
+        except ValueError:
+            # Not a whole line any more; the caller rebuilds
+            return False
+
+    def __getitem__(self, record_id):
+        record = self.get(record_id)
+        if record is None:
+            raise KeyError(record_id)
+        return record
+
+    def close(self):
+        self._close_map()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,272 @@
+"""
+OpenAI-compatible mock chat-completions server for running the pipeline offline.
+
+Every stage gets a well-formed answer in the format it parses (<decision>, <Evaluation_Framework>, Weighted Score,
+<new_query>, question_quality / tag JSON), with configurable latency, generation speed, injected 429/5xx errors
+and streaming, so throughput and resilience can be measured without a GPU:
+
+    python utils/mock_server.py --port 8004 --latency lognormal:0.5,0.4 --tokens-per-second 50 --error-rate 0.02
+
+then point a script's base_url at http://localhost:8004.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+
+# (marker in the prompt, response template) pairs, checked in order; the first match decides the stage format.
+# {filler} is the free text the model "thinks" before the block; {score}, {score_1..3} and {request_id} are
+# filled per request.
+STAGE_TEMPLATES = [
+    ("Evaluation_Framework", "{filler}\n<Evaluation_Framework>\n1. Correctness of the answer | 40\n"
+                             "2. Completeness of the explanation | 35\n3. Clarity and structure | 25\n"
+                             "<\\Evaluation_Framework>"),
+    ("Weighted Score", "{filler}\n<The Start of Evaluation Result>\nMetric 1 | score: [{score_1}]\n"
+                       "Metric 2 | score: [{score_2}]\nMetric 3 | score: [{score_3}]\n\n"
+                       "Final Weighted Score: [[{score}]]\n<The End of Evaluation Result>"),
+    ("<new_query>", "{filler}\n<new_query>Mock question {request_id}: explain the trade-offs of the approach "
+                    "described above.</new_query>"),
+    ("question_quality", "{filler}\nFinal Labels: {{\"question_quality\": [1, 2, 4]}}"),
+    ("<tags>", "{filler}\n<tags>{{\"Task Types\": [\"Other\"]}}</tags>"),
+    ("reparent", "{filler}\n<decision>{{'keep': []}}</decision>"),
+    ("<decision>", "{filler}\n<decision>ADD</decision>"),
+]
+DEFAULT_TEMPLATE = "{filler}"
+
+_FILLER_WORDS = ("the", "answer", "considers", "each", "step", "of", "problem", "and", "checks", "result", "carefully",
+                 "so", "that", "final", "output", "is", "consistent", "with", "question")
+
+
+def parse_distribution(spec):
+    """
+    Latency distribution from a spec such as "0.5" (fixed), "uniform:0.2,1", "normal:0.5,0.1",
+    "lognormal:0.5,0.4" (median, sigma) or "exponential:0.5" (mean). Returns a sampler taking a random.Random.
+    """
+    name, _, args = str(spec).partition(":")
+    try:
+        value = float(name)
+        return lambda rng: value
+    except ValueError:
+        pass
+    params = [float(x) for x in args.split(",") if x]
+    if name == "uniform":
+        return lambda rng: rng.uniform(params[0], params[1])
+    if name == "normal":
+        return lambda rng: max(0.0, rng.gauss(params[0], params[1]))
+    if name == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(params[0]), params[1])
+    if name == "exponential":
+        return lambda rng: rng.expovariate(1.0 / params[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class MockConfig(object):
+    """
+    :param latency: Time to first token, see parse_distribution
+    :param tokens_per_second: Generation speed of each request (0: the whole answer at once)
+    :param response_tokens: Words of free text generated before the stage's block (a distribution spec as well)
+    :param error_rate: Fraction of requests answered with a 500/502/503
+    :param rate_limit_rate: Fraction of requests answered with a 429
+    :param max_inflight: Answer 429 while more requests than this are being served (0: unlimited)
+    :param templates: Extra (marker, template) pairs tried before the built-in stage formats
+    :param seed: Seed of the random generator, for reproducible runs
+    """
+
+    def __init__(self, latency="0.05", tokens_per_second=0.0, response_tokens="20", error_rate=0.0,
+                 rate_limit_rate=0.0, max_inflight=0, templates=None, seed=None):
+        self.latency = parse_distribution(latency)
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = parse_distribution(response_tokens)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_inflight = max_inflight
+        self.templates = list(templates or []) + STAGE_TEMPLATES
+        self.rng = random.Random(seed)
+
+
+def render_response(config, messages, request_id):
+    prompt = "\n".join(str(message.get("content") or "") for message in messages)
+    template = next((template for marker, template in config.templates if marker in prompt), DEFAULT_TEMPLATE)
+    rng = config.rng
+    num_words = max(1, int(config.response_tokens(rng)))
+    filler = " ".join(rng.choice(_FILLER_WORDS) for _ in range(num_words)).capitalize() + "."
+    scores = [rng.randint(1, 3) for _ in range(3)]
+    return template.format(filler=filler, request_id=request_id, score_1=scores[0], score_2=scores[1],
+                           score_3=scores[2], score=40 * scores[0] + 35 * scores[1] + 25 * scores[2])
+
+
+def _tokens(text):
+    # Whitespace-separated words stand in for tokens; streaming sends one word per chunk
+    return re.findall(r"\S+\s*", text) or [text]
+
+
+def create_app(config=None):
+    config = config or MockConfig()
+    app = FastAPI()
+    stats = {"requests": 0, "in_flight": 0, "peak_in_flight": 0, "errors": 0, "rate_limited": 0, "streamed": 0}
+    app.state.stats = stats
+
+    def error(status_code, message, headers=None):
+        return JSONResponse(status_code=status_code, headers=headers,
+                            content={"error": {"message": message, "type": "mock_error", "code": status_code}})
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        if config.max_inflight and stats["in_flight"] >= config.max_inflight:
+            stats["rate_limited"] += 1
+            return error(429, "Too many requests in flight", {"retry-after": "1"})
+        roll = config.rng.random()
+        if roll < config.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return error(429, "Rate limit exceeded", {"retry-after": "1"})
+        if roll < config.rate_limit_rate + config.error_rate:
+            stats["errors"] += 1
+            return error(config.rng.choice([500, 502, 503]), "Injected server error")
+
+        stats["in_flight"] += 1
+        stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+        model = body.get("model", "mock")
+        messages = body.get("messages", [])
+        n = body.get("n") or 1
+        response_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        texts = [render_response(config, messages, response_id) for _ in range(n)]
+        prompt_tokens = sum(len(_tokens(str(m.get("content") or ""))) for m in messages)
+        completion_tokens = sum(len(_tokens(text)) for text in texts)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        delay = config.latency(config.rng)
+
+        if not body.get("stream"):
+            try:
+                generation = max(len(_tokens(text)) for text in texts) / config.tokens_per_second \
+                    if config.tokens_per_second else 0.0
+                await asyncio.sleep(delay + generation)
+            finally:
+                stats["in_flight"] -= 1
+            return {"id": response_id, "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": i, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"} for i, text in enumerate(texts)],
+                    "usage": usage}
+
+        stats["streamed"] += 1
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(index, delta, finish_reason=None, chunk_usage=None):
+            data = {"id": response_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [] if index is None else
+                    [{"index": index, "delta": delta, "finish_reason": finish_reason}]}
+            if chunk_usage is not None:
+                data["usage"] = chunk_usage
+            return f"data: {json.dumps(data)}\n\n"
+
+        async def events():
+            # Runs until the client disconnects; closing the stream early stops the "generation" like vLLM does
+            try:
+                await asyncio.sleep(delay)
+                for index, text in enumerate(texts):
+                    yield chunk(index, {"role": "assistant", "content": ""})
+                    for token in _tokens(text):
+                        if config.tokens_per_second:
+                            await asyncio.sleep(1.0 / config.tokens_per_second)
+                        yield chunk(index, {"content": token})
+                    yield chunk(index, {}, finish_reason="stop")
+                if include_usage:
+                    yield chunk(None, None, chunk_usage=usage)
+                yield "data: [DONE]\n\n"
+            finally:
+                stats["in_flight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    # Scripts use base URLs both with and without the /v1 prefix
+    app.post("/chat/completions")(chat_completions)
+    app.post("/v1/chat/completions")(chat_completions)
+
+    @app.get("/v1/models")
+    @app.get("/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+class BackgroundServer(object):
+    """Mock server running on a daemon thread of the current process, e.g. for benchmarks."""
+
+    def __init__(self, config=None, host="127.0.0.1", port=18080):
+        self.app = create_app(config)
+        self.url = f"http://{host}:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port, log_level="error"))
+        self.thread = threading.Thread(target=self.server.run, name="mock-server", daemon=True)
+
+    @property
+    def stats(self):
+        return self.app.state.stats
+
+    def start(self, timeout=10):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError(f"Mock server did not start on {self.url}")
+            time.sleep(0.05)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock server for offline pipeline runs.")
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind')
+    parser.add_argument('--port', type=int, default=8004, help='Port to listen on')
+    parser.add_argument('--latency', type=str, default='0.05',
+                        help='Time to first token: seconds, or uniform:a,b / normal:mean,std / lognormal:median,sigma '
+                             '/ exponential:mean')
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help='Generation speed, 0 for instant')
+    parser.add_argument('--response-tokens', type=str, default='20',
+                        help='Words generated before the stage block (same syntax as --latency)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failing with 5xx')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of requests failing with 429')
+    parser.add_argument('--max-inflight', type=int, default=0, help='Answer 429 above this many concurrent requests')
+    parser.add_argument('--templates', type=str, default=None,
+                        help='JSON file with [marker, template] pairs tried before the built-in stage formats')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    templates = None
+    if args.templates:
+        with open(args.templates, 'r', encoding='utf-8') as f:
+            templates = [tuple(pair) for pair in json.load(f)]
+    config = MockConfig(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                        response_tokens=args.response_tokens, error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate, max_inflight=args.max_inflight, templates=templates,
+                        seed=args.seed)
+    print(f"Mock server listening on http://{args.host}:{args.port}")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
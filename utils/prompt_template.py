@@ -0,0 +1,93 @@
+import string
+from utils.rate_limit import count_tokens
+
+
+class PromptTemplate(object):
+    """
+    A ``str.format`` prompt template parsed once, laid out for server-side prefix caching (vLLM
+    ``--enable-prefix-caching``).
+
+    Fields are split into shared ones (the question, criteria, baseline answer and critique: the same for every
+    candidate judged on a question) and ``varying`` ones (the candidate's answer). All varying fields must come after
+    the last shared field, so that the prompts of one question only differ in their tail and the server can reuse
+    the KV cache of everything before it. ``bind(**shared)`` renders that prefix once; ``.format(**varying)`` on the
+    result appends the tail.
+
+    The shared-prefix length of a prompt is ``bound.prefix_tokens``; ``report()`` summarizes them over all prompts.
+    """
+
+    def __init__(self, template, varying=("answer",), name="prompt"):
+        self.template = template
+        self.varying = set(varying)
+        self.name = name
+        self._formatter = string.Formatter()
+        segments = list(self._formatter.parse(template))
+        fields = [segment[1] for segment in segments]
+        split = next((i for i, field in enumerate(fields) if field in self.varying), len(segments))
+        late_shared = [field for field in fields[split:] if field is not None and field not in self.varying]
+        if late_shared:
+            raise ValueError(f"{name}: shared fields {late_shared} come after the varying fields "
+                             f"{sorted(self.varying)}; move them before, or the prompts of one question cannot share "
+                             f"a cached prefix")
+        self._prefix_segments = segments[:split]
+        if split < len(segments):
+            literal, field, spec, conversion = segments[split]
+            self._prefix_segments = self._prefix_segments + [(literal, None, None, None)]
+            self._suffix_segments = [("", field, spec, conversion)] + segments[split + 1:]
+        else:
+            self._suffix_segments = []
+        # Instructions before the first field: identical in every prompt made from this template
+        self.static_prefix = segments[0][0] if segments else ""
+        self.static_prefix_tokens = count_tokens(self.static_prefix)
+        # Running totals over the prompts formatted so far: count, shared prefix tokens (sum, min, max), prompt tokens
+        self.num_prompts = 0
+        self.prefix_tokens = [0, None, None]
+        self.prompt_tokens = 0
+
+    def _render(self, segments, kwargs):
+        parts = []
+        for literal, field, spec, conversion in segments:
+            parts.append(literal)
+            if field is not None:
+                value, _ = self._formatter.get_field(field, (), kwargs)
+                value = self._formatter.convert_field(value, conversion)
+                parts.append(self._formatter.format_field(value, spec or ""))
+        return "".join(parts)
+
+    def bind(self, **shared):
+        """Render the shared prefix once, e.g. per question; format the candidates on the returned object."""
+        return BoundPrompt(self, self._render(self._prefix_segments, shared))
+
+    def format(self, **kwargs):
+        # Drop-in replacement for str.format
+        prefix_kwargs = {key: value for key, value in kwargs.items() if key not in self.varying}
+        return self.bind(**prefix_kwargs).format(**kwargs)
+
+    def _record(self, prefix_tokens, prompt_tokens):
+        total, low, high = self.prefix_tokens
+        self.prefix_tokens = [total + prefix_tokens, min(low, prefix_tokens) if low is not None else prefix_tokens,
+                              max(high, prefix_tokens) if high is not None else prefix_tokens]
+        self.prompt_tokens += prompt_tokens
+        self.num_prompts += 1
+
+    def report(self):
+        if not self.num_prompts:
+            return
+        total, low, high = self.prefix_tokens
+        print(f"{self.name}: {self.num_prompts} prompts, {self.static_prefix_tokens} static instruction tokens, "
+              f"shared prefix per question {low}-{high} tokens (mean {total / self.num_prompts:.0f}, "
+              f"{total / max(1, self.prompt_tokens):.0%} of prompt tokens)")
+
+
+class BoundPrompt(object):
+    """A PromptTemplate with its shared fields filled in."""
+
+    def __init__(self, template, prefix):
+        self.template = template
+        self.prefix = prefix
+        self.prefix_tokens = count_tokens(prefix)
+
+    def format(self, **varying):
+        tail = self.template._render(self.template._suffix_segments, varying)
+        self.template._record(self.prefix_tokens, self.prefix_tokens + count_tokens(tail))
+        return self.prefix + tail
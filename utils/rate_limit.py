@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken is optional, fall back to a character-based estimate
+    _encoding = None
+
+
+def count_tokens(text):
+    return len(_encoding.encode(text)) if _encoding is not None else len(text) // 4 + 1
+
+
+def estimate_prompt_tokens(messages):
+    """Estimate the prompt tokens of a chat request before sending it (exact counts come back in `usage`)."""
+    num_tokens = 3
+    for message in messages:
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = str(content)
+        num_tokens += 4 + count_tokens(content)
+    return num_tokens
+
+
+class TokenBucket(object):
+    """Refills continuously at `rate_per_minute`, holding at most `burst_seconds` worth of capacity."""
+
+    def __init__(self, rate_per_minute, burst_seconds=5.0):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, amount):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Waiters are served in order; a request larger than the capacity waits for a full bucket and runs into debt
+        async with self._lock:
+            while True:
+                self._refill()
+                needed = min(amount, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def adjust(self, amount):
+        # Positive: consume more (actual usage above the estimate), negative: give back
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter(object):
+    """Requests-per-minute and tokens-per-minute budget of one (base_url, model)."""
+
+    def __init__(self, rpm=None, tpm=None, headroom=0.95):
+        self.requests = TokenBucket(rpm * headroom) if rpm else None
+        self.tokens = TokenBucket(tpm * headroom) if tpm else None
+        # Running mean of completion tokens, used to reserve for the answer before it is known
+        self.mean_completion_tokens = 256.0
+
+    async def acquire(self, messages, generation_params):
+        """Wait until the request fits in the budget; returns the number of tokens reserved for it."""
+        if self.requests is not None:
+            await self.requests.take(1)
+        if self.tokens is None:
+            return 0
+        max_tokens = generation_params.get("max_completion_tokens") or generation_params.get("max_tokens")
+        completion_tokens = min(max_tokens, self.mean_completion_tokens) if max_tokens else self.mean_completion_tokens
+        reserved = estimate_prompt_tokens(messages) + int(completion_tokens * generation_params.get("n", 1))
+        await self.tokens.take(reserved)
+        return reserved
+
+    def reconcile(self, reserved, usage):
+        """Correct the token budget with the `usage` of the response (None if the request failed)."""
+        if self.tokens is None:
+            return
+        if usage is None:
+            self.tokens.adjust(-reserved)
+            return
+        self.tokens.adjust(usage.total_tokens - reserved)
+        self.mean_completion_tokens += 0.1 * ((usage.completion_tokens or 0) - self.mean_completion_tokens)
+
+
+class RateLimitRegistry(object):
+    """
+    Rate limiters per (base_url, model), configured with a dict such as
+    ``{("https://api.example.com/v1", "gpt-4o"): {"rpm": 500, "tpm": 200000}, "http://localhost:8004": {"rpm": 60}}``.
+    Keys are (base_url, model) pairs or a bare base_url applying to every model served there.
+    """
+
+    def __init__(self, rate_limits):
+        self.rate_limits = rate_limits or {}
+        self.limiters = {}
+
+    def get(self, base_url, model):
+        key = (base_url, model)
+        if key not in self.limiters:
+            config = self.rate_limits.get(key) or self.rate_limits.get(base_url)
+            self.limiters[key] = RateLimiter(**config) if config else None
+        return self.limiters[key]
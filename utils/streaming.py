@@ -0,0 +1,87 @@
+import time
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from utils import telemetry
+from utils.rate_limit import estimate_prompt_tokens
+
+
+def closing_tag_predicate(tags, reasoning=False):
+    """
+    Stop once one of `tags` (e.g. "</decision>") has been generated. Everything up to the last </think> is
+    reasoning and ignored, so a reasoning model mentioning the tag while thinking is not cut off, also when its chat
+    template opens the <think> block itself (QwQ) and only </think> is streamed. With `reasoning` the model is known
+    to think first, and a tag only counts once </think> has been generated.
+    """
+    tags = [tags] if isinstance(tags, str) else list(tags)
+
+    def predicate(text):
+        end = text.rfind("</think>")
+        if end != -1:
+            text = text[end:]
+        elif reasoning or "<think>" in text:
+            return False
+        return any(tag in text for tag in tags)
+    return predicate
+
+
+def stop_predicate(stop_when, reasoning=False):
+    """
+    stop_when is a closing tag, a list of alternative closing tags, a callable taking the text so far, or None;
+    `reasoning` applies to closing tags, see closing_tag_predicate.
+    """
+    if stop_when is None or callable(stop_when):
+        return stop_when
+    return closing_tag_predicate(stop_when, reasoning)
+
+
+def stop_key(stop_when):
+    # Part of the cache key: a cut-off response must not be served to a caller that wants the full one
+    if stop_when is None or isinstance(stop_when, str):
+        return stop_when
+    if callable(stop_when):
+        return getattr(stop_when, "__qualname__", repr(stop_when))
+    return list(stop_when)
+
+
+async def stream_completion_until(client, model, messages, stop_when, **kwargs):
+    """
+    Stream a chat completion and cancel it as soon as ``stop_when`` is satisfied, returning the partial text as a
+    regular ChatCompletion. Closing the stream drops the connection, which makes vLLM abort the generation.
+    Usage comes from the stream's final chunk, and is only estimated (and marked as such in the telemetry) when the
+    stream is cut off before the server reports it.
+    """
+    predicate = stop_predicate(stop_when)
+    text = ""
+    usage = None
+    finish_reason = "stop"
+    response_id, created = "", int(time.time())
+    kwargs.setdefault("stream_options", {"include_usage": True})
+    stream = await client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+    try:
+        async for chunk in stream:
+            response_id, created = chunk.id or response_id, chunk.created or created
+            usage = getattr(chunk, "usage", None) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if not delta:
+                continue
+            text += delta
+            if predicate is not None and predicate(text):
+                break
+    finally:
+        await stream.close()
+    if usage is None:
+        telemetry.usage_estimated()
+        prompt_tokens = estimate_prompt_tokens(messages)
+        completion_tokens = len(text) // 4 + 1
+        usage = CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                total_tokens=prompt_tokens + completion_tokens)
+    return ChatCompletion(
+        id=response_id, created=created, model=model, object="chat.completion",
+        choices=[Choice(index=0, finish_reason=finish_reason,
+                        message=ChatCompletionMessage(role="assistant", content=text))],
+        usage=usage)
@@ -0,0 +1,357 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+
+# Upper bounds (seconds) of the histogram buckets, shared by every timing metric
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+EXPORT_INTERVAL = 30.0
+
+# Attempt in flight in the current task, for the HTTP client's response hook
+_current_request = contextvars.ContextVar("current_request", default=None)
+# When the item processed by the current task was pulled from the input
+_item_enqueued = contextvars.ContextVar("item_enqueued", default=None)
+
+
+def usage_estimated():
+    # The usage of the current request's response is an estimate (a stream cut off before the server reported it)
+    record = _current_request.get()
+    if record is not None:
+        record.usage_estimated = True
+
+
+async def on_response(response):
+    """httpx response hook: the status line and headers of the current attempt have arrived."""
+    record = _current_request.get()
+    if record is not None and record.first_byte is None:
+        record.first_byte = time.monotonic()
+
+
+class Histogram(object):
+    """Cumulative-bucket histogram in the Prometheus layout; quantiles are interpolated within buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else lower * 2
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {"count": self.count, "mean": self.sum / self.count, "p50": self.quantile(0.5),
+                "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+
+class RequestRecord(object):
+    """Timeline of one upstream request (including its retries); times are time.monotonic()."""
+
+    def __init__(self, model):
+        self.model = model
+        self.enqueued = _item_enqueued.get() or time.monotonic()
+        self.sent = None  # First attempt
+        self.attempt_sent = None  # Latest attempt, the one first_byte belongs to
+        self.first_byte = None
+        self.finished = None
+        self.endpoint = None
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.usage_estimated = False
+
+    def attempt(self, endpoint):
+        """Called right before an attempt goes out on the wire; every attempt after the first is a retry."""
+        now = time.monotonic()
+        if self.sent is not None:
+            self.retries += 1
+        self.sent = self.sent or now
+        self.attempt_sent = now
+        self.first_byte = None
+        self.usage_estimated = False
+        self.endpoint = endpoint
+        _current_request.set(self)
+
+
+class _EndpointStats(object):
+
+    def __init__(self):
+        self.queue_wait = Histogram()  # Enqueued -> first attempt sent: worker slots, rate limits, endpoint limits
+        self.ttfb = Histogram()  # Last attempt sent -> response headers
+        self.latency = Histogram()  # First attempt sent -> done, including retries
+        self.outcomes = {}
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.estimated_usage = 0  # Requests whose tokens are estimates, not the server's usage
+
+    def merge(self, other):
+        for name in ("queue_wait", "ttfb", "latency"):
+            getattr(self, name).merge(getattr(other, name))
+        for outcome, count in other.outcomes.items():
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+        self.retries += other.retries
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.estimated_usage += other.estimated_usage
+
+    def to_dict(self):
+        return {"requests": dict(self.outcomes), "retries": self.retries, "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens, "estimated_usage": self.estimated_usage,
+                "queue_wait_seconds": self.queue_wait.summary(),
+                "ttfb_seconds": self.ttfb.summary(), "latency_seconds": self.latency.summary()}
+
+
+class StageTelemetry(object):
+    """
+    Request telemetry of one pipeline stage, accumulated over every run of the process with that stage name.
+
+    Besides the per-endpoint request metrics it tracks the consumer side: how long results wait to be taken and
+    how much time the caller's loop body (parsing, writing) takes. Together they tell a judge-bound run (high
+    ttfb/latency) from a network- or quota-bound one (high queue wait) and a writer-bound one (the consumer busy
+    most of the time, results waiting).
+
+    With an ``export_dir``, ``<stage>.json`` and ``<stage>.prom`` (Prometheus text format) are written there every
+    EXPORT_INTERVAL seconds and at the end of each run.
+    """
+
+    def __init__(self, stage, export_dir=None):
+        self.stage = stage
+        self.export_dir = export_dir
+        self.first_request = None
+        self.endpoints = {}
+        self.items = 0
+        self.cache_hits = 0
+        self.parse_outcomes = {}  # Answers accepted / rejected by the parse callback, items given up on
+        self.result_wait = Histogram()  # Item done -> taken by the consumer
+        self.consumer_seconds = 0.0
+        self._enqueued = {}
+        self._finished = {}
+        self._lock = threading.Lock()
+        self._last_export = time.monotonic()
+
+    # Item level, driven by utils._run
+
+    def track_input(self, items):
+        # The engine pulls the next item right before submitting it, so pull time is the enqueue time
+        for obj in items:
+            self._enqueued[id(obj)] = time.monotonic()
+            yield obj
+
+    async def run_item(self, obj, coro_fn):
+        _item_enqueued.set(self._enqueued.pop(id(obj), None))
+        # Only successful items are sure to reach consumed(); failed ones are not handed to the caller unless it
+        # asked for them, so no finish time is kept for those
+        result = await coro_fn()
+        self._finished[id(obj)] = time.monotonic()
+        return result
+
+    def consumed(self, obj):
+        finished = self._finished.pop(id(obj), None)
+        with self._lock:
+            self.items += 1
+            if finished is not None:
+                self.result_wait.observe(time.monotonic() - finished)
+        self.maybe_export()
+
+    def consumer_busy(self, seconds):
+        with self._lock:
+            self.consumer_seconds += seconds
+
+    # Request level, driven by _RunState
+
+    def request_started(self, model):
+        record = RequestRecord(model)
+        with self._lock:
+            self.first_request = self.first_request or record.enqueued
+        return record
+
+    def request_finished(self, record, response=None, outcome="ok"):
+        record.finished = time.monotonic()
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            record.prompt_tokens = usage.prompt_tokens or 0
+            record.completion_tokens = usage.completion_tokens or 0
+        with self._lock:
+            stats = self.endpoints.setdefault(record.endpoint or "none", _EndpointStats())
+            stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+            stats.retries += record.retries
+            stats.prompt_tokens += record.prompt_tokens
+            stats.completion_tokens += record.completion_tokens
+            if usage is not None and record.usage_estimated:
+                stats.estimated_usage += 1
+            if record.sent is not None:
+                stats.queue_wait.observe(record.sent - record.enqueued)
+                stats.latency.observe(record.finished - record.sent)
+            if record.first_byte is not None:
+                stats.ttfb.observe(record.first_byte - record.attempt_sent)
+        self.maybe_export()
+
+    def cache_hit(self, count=1):
+        with self._lock:
+            self.cache_hits += count
+
+    def parse_result(self, outcome):
+        # "accepted", "rejected" (asked again or given up) or "gave_up"
+        with self._lock:
+            self.parse_outcomes[outcome] = self.parse_outcomes.get(outcome, 0) + 1
+
+    # Export
+
+    def summary(self):
+        with self._lock:
+            total = _EndpointStats()
+            for stats in self.endpoints.values():
+                total.merge(stats)
+            elapsed = time.monotonic() - self.first_request if self.first_request else 0.0
+            completed = sum(total.outcomes.values())
+            return {
+                "stage": self.stage, "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "elapsed_seconds": elapsed, "items": self.items, "cache_hits": self.cache_hits,
+                "parse": dict(self.parse_outcomes),
+                "throughput": {"requests_per_second": completed / elapsed if elapsed else None,
+                               "completion_tokens_per_second": total.completion_tokens / elapsed if elapsed else None},
+                "consumer": {"busy_seconds": self.consumer_seconds,
+                             "busy_fraction": self.consumer_seconds / elapsed if elapsed else None,
+                             "result_wait_seconds": self.result_wait.summary()},
+                "all": total.to_dict(),
+                "endpoints": {endpoint: stats.to_dict() for endpoint, stats in self.endpoints.items()},
+            }
+
+    def prometheus(self):
+        lines = []
+
+        def histogram(name, help_text, series):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, hist in series:
+                cumulative = 0
+                for bound, count in zip(list(BUCKETS) + ["+Inf"], hist.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {hist.sum}")
+                lines.append(f"{name}_count{{{labels}}} {hist.count}")
+
+        def counter(name, help_text, series):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series:
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        with self._lock:
+            stage = f'stage="{_escape(self.stage)}"'
+            endpoints = [(f'{stage},endpoint="{_escape(endpoint)}"', stats) for endpoint, stats in self.endpoints.items()]
+            for metric, help_text in (("queue_wait", "Time from enqueue to the first attempt being sent"),
+                                      ("ttfb", "Time from sending the last attempt to the response headers"),
+                                      ("latency", "Time from sending the first attempt to completion")):
+                histogram(f"feedbacker_request_{metric}_seconds", help_text,
+                          [(labels, getattr(stats, metric)) for labels, stats in endpoints])
+            counter("feedbacker_requests_total", "Upstream requests by outcome",
+                    [(f'{labels},outcome="{outcome}"', count) for labels, stats in endpoints
+                     for outcome, count in stats.outcomes.items()])
+            counter("feedbacker_request_retries_total", "Retried attempts",
+                    [(labels, stats.retries) for labels, stats in endpoints])
+            counter("feedbacker_prompt_tokens_total", "Prompt tokens from usage",
+                    [(labels, stats.prompt_tokens) for labels, stats in endpoints])
+            counter("feedbacker_completion_tokens_total", "Completion tokens from usage",
+                    [(labels, stats.completion_tokens) for labels, stats in endpoints])
+            counter("feedbacker_estimated_usage_total", "Requests whose token counts are estimates (cut-off streams)",
+                    [(labels, stats.estimated_usage) for labels, stats in endpoints])
+            counter("feedbacker_items_total", "Items handed to the consumer", [(stage, self.items)])
+            counter("feedbacker_cache_hits_total", "Samples served from the response cache", [(stage, self.cache_hits)])
+            counter("feedbacker_parse_total", "Answers checked by the parse callback, by outcome",
+                    [(f'{stage},outcome="{outcome}"', count) for outcome, count in self.parse_outcomes.items()])
+            counter("feedbacker_consumer_busy_seconds_total", "Time spent in the consumer's loop body",
+                    [(stage, self.consumer_seconds)])
+            histogram("feedbacker_result_wait_seconds", "Time from an item being done to the consumer taking it",
+                      [(stage, self.result_wait)])
+        return "\n".join(lines) + "\n"
+
+    def maybe_export(self):
+        if self.export_dir and time.monotonic() - self._last_export >= EXPORT_INTERVAL:
+            self.export()
+
+    def export(self):
+        self._last_export = time.monotonic()
+        if not self.export_dir:
+            return
+        try:
+            os.makedirs(self.export_dir, exist_ok=True)
+            base = os.path.join(self.export_dir, self.stage)
+            # Write to a temporary file and rename, so a scraper never reads a half-written file
+            for path, content in ((base + ".json", json.dumps(self.summary(), indent=2) + "\n"),
+                                  (base + ".prom", self.prometheus())):
+                with open(path + ".tmp", 'w', encoding='utf-8') as file:
+                    file.write(content)
+                os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Could not export telemetry to {self.export_dir}: {e}")
+
+    def report(self):
+        summary = self.summary()
+        total, consumer = summary["all"], summary["consumer"]
+        if not total["requests"]:
+            return
+
+        def p50(metric):
+            value = total[metric].get("p50")
+            return f"{value:.2f}s" if value is not None else "-"
+        busy = consumer["busy_fraction"]
+        busy = f"{busy:.0%}" if busy is not None else "-"
+        parse = f", parse {summary['parse']}" if summary["parse"] else ""
+        print(f"Telemetry [{self.stage}]: {sum(total['requests'].values())} requests {total['requests']}, "
+              f"{total['retries']} retries, p50 queue wait {p50('queue_wait_seconds')}, "
+              f"ttfb {p50('ttfb_seconds')}, latency {p50('latency_seconds')}, consumer busy {busy}{parse}")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_stages = {}
+
+
+def default_stage():
+    # Name of the running script, e.g. "2.3.final_evaluation"
+    return os.path.splitext(os.path.basename(sys.argv[0] or ""))[0] or "default"
+
+
+def get_stage(stage=None, export_dir=None):
+    """
+    Process-wide telemetry of a stage. Exports go to ``export_dir``, else FEEDBACKER_TELEMETRY_DIR, else
+    outputs/telemetry; pass an empty string to disable them.
+    """
+    stage = stage or default_stage()
+    if export_dir is None:
+        export_dir = os.environ.get("FEEDBACKER_TELEMETRY_DIR", os.path.join("outputs", "telemetry"))
+    telemetry = _stages.get(stage)
+    if telemetry is None:
+        telemetry = _stages[stage] = StageTelemetry(stage, export_dir)
+    telemetry.export_dir = export_dir
+    return telemetry
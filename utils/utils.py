@@ -1,11 +1,18 @@
 from pathlib import Path
 from typing import Union
 import os
+import contextlib
+import contextvars
 import json
+import random
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
-from tenacity import retry, stop_after_attempt, wait_random_exponential
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from openai import OpenAI
+from openai.types.chat import ChatCompletion
+from utils import engine, clients, concurrency, balancer, cache, rate_limit, errors, streaming, jsonl_index, telemetry, prompt_template, batch
 
 
 def read_prompt(input_path: Union[str, Path]) -> str:
@@ -25,17 +32,100 @@ def read_prompt(input_path: Union[str, Path]) -> str:
     return content
 
 
-def read_jsonl_file(file_path: Union[str, Path], max_sample_size: int = None) -> list:
-    data = []
-    with open(file_path, 'r', encoding='utf-8') as file:
+def load_prompt_template(input_path: Union[str, Path], varying=("answer",)) -> "prompt_template.PromptTemplate":
+    """
+    Read a prompt file as a PromptTemplate: parsed once, with the `varying` fields (the candidate answer) required
+    to come last so that prompts sharing everything else hit the server's prefix cache. Use
+    ``template.bind(question=..., ...).format(answer=...)`` or ``template.format(...)`` like str.format.
+    """
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    return prompt_template.PromptTemplate(read_prompt(input_path), varying=varying, name=name)
+
+
+def _parse_jsonl_line(line: bytes, fields=None):
+    obj = jsonl_index.loads(line)
+    if fields is not None:
+        # Field projection: keep only what the caller needs, the rest of the record is freed right away
+        obj = {key: obj[key] for key in fields if key in obj}
+    return obj
+
+
+def _parse_jsonl_chunk(file_path, start, end, fields):
+    # Runs in a worker process: parse the lines in [start, end) of the file
+    data, invalid = [], []
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        for line in file.read(end - start).splitlines():
+            try:
+                data.append(_parse_jsonl_line(line, fields))
+            except Exception as e:
+                invalid.append((line, e))
+    return data, invalid
+
+
+def _jsonl_chunks(file_path, num_chunks):
+    # Split the file into byte ranges that start and end on line boundaries
+    size = os.path.getsize(file_path)
+    offsets = [0]
+    with open(file_path, 'rb') as file:
+        for i in range(1, num_chunks):
+            file.seek(max(offsets[-1], size * i // num_chunks))
+            file.readline()
+            offsets.append(min(file.tell(), size))
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+
+def iter_jsonl_file(file_path: Union[str, Path], max_sample_size: int = None, fields=None, num_workers: int = None,
+                    chunk_size_mb: int = 64):
+    """
+    Read a JSONL file lazily, one record at a time. Invalid lines are reported and skipped.
+
+    :param file_path: File path
+    :param max_sample_size: Only read this many lines
+    :param fields: Keep only these keys of every record (e.g. ["id", "score"])
+    :param num_workers: Parse files larger than chunk_size_mb in chunks with this many processes (records keep
+        their order)
+    :return: Generator of records; can be passed directly to process_data_async
+    """
+    def report(line, e):
+        text = line.decode('utf-8', errors='replace').strip()
+        print(f"Skipping invalid JSON line: {text}. {e}")
+
+    if num_workers and num_workers > 1 and max_sample_size is None \
+            and os.path.getsize(file_path) > chunk_size_mb * 1024 * 1024:
+        num_chunks = max(num_workers, os.path.getsize(file_path) // (chunk_size_mb * 1024 * 1024) + 1)
+        chunks = _jsonl_chunks(file_path, num_chunks)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for data, invalid in executor.map(_parse_jsonl_chunk, [file_path] * len(chunks),
+                                              [start for start, _ in chunks], [end for _, end in chunks],
+                                              [fields] * len(chunks)):
+                for line, e in invalid:
+                    report(line, e)
+                yield from data
+        return
+
+    with open(file_path, 'rb') as file:
         for line_count, line in enumerate(file):
             if max_sample_size is not None and line_count >= max_sample_size:
                 break
             try:
-                data.append(json.loads(line.strip()))
+                yield _parse_jsonl_line(line, fields)
             except Exception as e:
-                print(f"Skipping invalid JSON line: {line.strip()}. {e}")
-    return data
+                report(line, e)
+
+
+def read_jsonl_file(file_path: Union[str, Path], max_sample_size: int = None, fields=None,
+                    num_workers: int = None) -> list:
+    return list(iter_jsonl_file(file_path, max_sample_size, fields=fields, num_workers=num_workers))
+
+
+def index_jsonl_file(file_path: Union[str, Path], key: str = "id") -> "jsonl_index.JsonlIndex":
+    """
+    Open (building or extending as needed) the persistent id index of a JSONL file, for joins and lookups by id
+    that only decode the records they touch: ``index.get(id)``, ``id in index``, ``index.ids()``.
+    """
+    return jsonl_index.JsonlIndex(file_path, key=key)
 
 
 def write_jsonl_file(data: list, file_path: Union[str, Path]) -> list:
@@ -46,73 +136,734 @@ def write_jsonl_file(data: list, file_path: Union[str, Path]) -> list:
     print(f"JSONL file has been saved to {file_path}")
 
 
-# Use @retry decorator to define a retry mechanism for API call failures. The retry strategy is random exponential backoff, with a maximum of 99999 attempts
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(99999))
-def completion_with_backoff_openai_api(client, model, messages, stream=False, **kwargs):
-    completions = client.chat.completions.create(model=model, messages=messages, stream=stream, **kwargs)
-    return completions
-
-
-def api_query(messages, model_name, sample_num, base_url, api_key, generation_params):
-    client = OpenAI(base_url=base_url, api_key=api_key)
-    responses = []
-    for _ in range(sample_num):
-        # ========= debug =========
-        # try:
-        #     response = client.chat.completions.create(model=model_name, messages=messages, stream=False)
-        #     print(response)
-        # except Exception as e:
-        #     print(e)
-        # =========================
-        response = completion_with_backoff_openai_api(client=client, model=model_name, messages=messages, stream=False,
-                                                      **generation_params)
-        content = response.choices[0].message.content
-        responses.append(content)
-    return responses
-
-
-def process_data_async(test_data, model, sample_num, base_url, api_key, generation_params, max_workers=32):
-    print(f"process_data started with max workers of {max_workers}")
-    futures = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        for obj in test_data:
-            future = executor.submit(api_query, obj["input_ques"], model, sample_num, base_url, api_key,
-                                     generation_params)
-            futures.append((future, obj))
-        future_to_obj = {future: obj for future, obj in futures}
-        for future in tqdm(as_completed(future_to_obj.keys()), total=len(test_data)):  # Process results in completion order
-            obj = future_to_obj[future]
+class JsonlWriter(object):
+    """
+    Appends records to a JSONL file with group commit: lines are written and fsynced by a background thread
+    every `flush_every` records or `flush_interval` seconds, whichever comes first, instead of one fsync per record.
+
+    On a crash at most that window of records is lost, and the resume logic simply requests them again.
+    Records are serialized in write(), so callers may reuse or mutate objects afterwards.
+
+    With `index_key` set (the default "id"), the id index of the file (see index_jsonl_file) is extended after every
+    commit, so it doubles as the resume ledger read by filter_processed_data.
+    """
+
+    def __init__(self, file_path: Union[str, Path], flush_every: int = 256, flush_interval: float = 1.0,
+                 fsync: bool = True, index_key: str = "id"):
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.index_key = index_key
+        self.num_written = 0
+        self._queue = queue.Queue()
+        self._error = None
+        self._file = open(file_path, 'ab+')
+        # A crash can leave a partial last line; terminate it so the next record does not get glued onto it
+        if self._file.tell() > 0:
+            self._file.seek(-1, os.SEEK_END)
+            if self._file.read(1) != b"\n":
+                self._file.write(b"\n")
+                self._file.flush()
+        self._index = jsonl_index.JsonlIndex(file_path, key=index_key) if index_key else None
+        self._thread = threading.Thread(target=self._run, name="jsonl-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, obj):
+        if self._error is not None:
+            raise self._error
+        record_id = obj.get(self.index_key) if self.index_key and isinstance(obj, dict) else None
+        self._queue.put((record_id, (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")))
+
+    def flush(self):
+        """Block until every record written so far is on disk."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._index is not None:
+            self._index.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _commit(self, records):
+        if records:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(b"".join(line for _, line in records))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.num_written += len(records)
+            # Only ids of records that are on disk go into the index, so a crash never marks a lost record done
+            if self._index is not None:
+                self._index.add([(record_id, len(line)) for record_id, line in records], offset)
+
+    def _run(self):
+        records = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
             try:
-                responses = future.result()
-                yield responses, obj
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            try:
+                if isinstance(item, tuple) and item:
+                    records.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+                    if len(records) < self.flush_every:
+                        continue
+                self._commit(records)
             except Exception as e:
-                print(f"Error processing item: {e}")
-                continue
+                self._error = e
+            records = []
+            deadline = None
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+
+def build_requests(records, render, model=None, base_url=None, api_key=None, id_suffix=None,
+                   id_key_name: str = "id") -> list:
+    """
+    Turn input records into request items for process_data_async / process_data_async_spe_model.
+
+    Each request is a shallow copy of its record (nested values such as reference answers are shared, not copied),
+    plus "input_ques" and, if `model` is set, the query_* keys.
+
+    :param records: Iterable of dicts, or a mapping of equal-length columns (e.g. pyarrow's Table.to_pydict())
+    :param render: Function from a record to its chat messages; records it raises on are reported and skipped
+    :param id_suffix: Appended to the id, for several requests per record
+    :return: List of requests
+    """
+    if isinstance(records, dict):
+        columns = records
+        records = (dict(zip(columns, row)) for row in zip(*columns.values()))
+    requests = []
+    for i, record in enumerate(tqdm(records)):
+        try:
+            request = dict(record)
+            if id_suffix:
+                request[id_key_name] = request[id_key_name] + id_suffix
+            request["input_ques"] = render(record)
+            if model is not None:
+                request["query_model"] = model
+                request["query_base_url"] = base_url  # A list of replicas is chosen from per request
+                request["query_api_key"] = api_key
+            requests.append(request)
+        except Exception as e:
+            print(f"Error at index {i}: {e}")
+    return requests
+
+
+def filter_processed_data(full_data, save_path: Union[str, Path], id_key_name: str = "id") -> list:
+    """
+    Resume support: drop the items whose `id_key_name` already appears in the output file `save_path`.
+
+    The processed ids come from the output's id index, which JsonlWriter extends as it writes, so startup cost
+    grows with the index rather than the output; only records appended by other means are parsed.
+    """
+    return list(iter_unprocessed_data(full_data, save_path, id_key_name))
+
+
+def iter_unprocessed_data(full_data, save_path: Union[str, Path], id_key_name: str = "id"):
+    """
+    Lazy filter_processed_data: a generator of the items not yet in `save_path`, so that a stream of requests can
+    be handed to process_data_* as is. The output's index is opened when iteration starts.
+    """
+    if not os.path.exists(save_path):
+        yield from full_data
+        return
+    with jsonl_index.JsonlIndex(save_path, key=id_key_name) as index:
+        for obj in full_data:
+            if obj.get(id_key_name, None) not in index:
+                yield obj
+
+
+def _get_cached_completion(response_cache, key):
+    if response_cache is None:
+        return None
+    value = response_cache.get(key)
+    return ChatCompletion.model_validate_json(value) if value is not None else None
+
+
+def _put_cached_completion(response_cache, key, response):
+    if response_cache is not None:
+        response_cache.put(key, response.model_dump_json())
+
+
+# Cache entries of the parse attempt running in this task, as (key, response) pairs with None for cache hits; set by
+# _RunState.run_item so that only answers the parser accepts are kept
+_cache_writes = contextvars.ContextVar("cache_writes", default=None)
+
+
+def _split_choices(response):
+    # One ChatCompletion per choice, so that samples obtained with `n` are cached and used like single calls
+    choices = sorted(response.choices, key=lambda choice: choice.index)
+    return [response.model_copy(update={"choices": [choice.model_copy(update={"index": 0})]}) for choice in choices]
+
+
+async def async_completion_openai_api(client, model, messages, stream=False, **kwargs):
+    # A single attempt; retries, backoff and endpoint limits are handled by _RunState, the only request path
+    return await client.chat.completions.create(model=model, messages=messages, stream=stream, **kwargs)
+
 
+class _RunState(object):
+    """Resources shared by all requests of one process_data_async run."""
 
-def process_data_async_spe_model(test_data, sample_num, generation_params, max_workers=32):
+    def __init__(self, max_workers, http2=False, adaptive_concurrency=True, deduplicate=True, rate_limits=None,
+                 max_attempts=errors.MAX_ATTEMPTS, retry_budget_ratio=0.2, use_n=False, stop_when=None, reasoning=False,
+                 stage=None, telemetry_dir=None, parse=None, max_parse_attempts=3):
+        # Clients are pooled per (base_url, api_key) for the whole run and released once the generator finishes
+        self.clients = clients.AsyncClientLease(max_workers=max_workers, http2=http2)
+        # Per-endpoint AIMD limits below the global max_workers ceiling
+        self.concurrency = concurrency.ConcurrencyController(max_workers) if adaptive_concurrency else None
+        # Dispatch-time choice among several base_urls
+        self.balancer = balancer.LoadBalancer()
+        # Opt-in persistent cache, see cache.enable_response_cache
+        self.response_cache = cache.get_response_cache()
+        self.cache_counts = (self.response_cache.hits, self.response_cache.misses) if self.response_cache else None
+        # SQLite reads and writes run on a thread of their own, in order, rather than on the event loop
+        self.cache_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache") \
+            if self.response_cache else None
+        # Identical requests in flight at the same time share one upstream call
+        self.single_flight = engine.SingleFlight() if deduplicate else None
+        # Optional RPM/TPM budgets per (base_url, model)
+        self.rate_limits = rate_limit.RateLimitRegistry(rate_limits)
+        # Transient errors are retried up to max_attempts times while the run's retry budget lasts
+        self.max_attempts = max_attempts
+        self.retry_budget = errors.RetryBudget(ratio=retry_budget_ratio)
+        self.failures = {}
+        # Multi-sample generation with one `n` request; (model, endpoints) that rejected or ignored `n`
+        self.use_n = use_n
+        self.n_unsupported = set()
+        # Stream and cut off the generation once the block the stage parses is complete
+        self.stop_when = stop_when
+        self.reasoning = reasoning
+        self.stop_predicate = streaming.stop_predicate(stop_when, reasoning)
+        # Per-request timings, tokens and retries, accumulated per stage (default: the script name)
+        self.telemetry = telemetry.get_stage(stage, telemetry_dir)
+        # Answers the stage's parser rejects are asked again right away, up to max_parse_attempts times per item
+        self.parse = parse
+        self.max_parse_attempts = max_parse_attempts
+
+    async def run_item(self, obj, request_fn):
+        # request_fn(attempt) returns the item's responses; an attempt > 1 is never served from the cache
+        first_attempt = obj.get("query_attempt", 1)
+        if self.parse is None:
+            return await request_fn(first_attempt)
+        for attempt in range(first_attempt, first_attempt + self.max_parse_attempts):
+            # The attempt's responses are cached only once the parser accepts them, and a rejected cache hit is
+            # dropped, so that a rerun asks again instead of replaying a rejected answer
+            writes = []
+            token = _cache_writes.set(writes)
+            try:
+                responses = await request_fn(attempt)
+            finally:
+                _cache_writes.reset(token)
+            result, reason = _parse_responses(self.parse, responses)
+            await self._settle_cache_writes(writes, accepted=result is not None)
+            if result is not None:
+                self.telemetry.parse_result("accepted")
+                return result
+            self.telemetry.parse_result("rejected")
+        self.telemetry.parse_result("gave_up")
+        raise _parse_failure(reason, responses, self.max_parse_attempts)
+
+    async def _cache_io(self, fn, *args):
+        if self.response_cache is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.cache_executor, fn, *args)
+
+    async def _settle_cache_writes(self, writes, accepted):
+        if self.response_cache is None:
+            return
+        for key, response in writes:
+            if accepted and response is not None:
+                await self._cache_io(_put_cached_completion, self.response_cache, key, response)
+            elif not accepted and response is None:
+                await self._cache_io(self.response_cache.delete, key)
+
+    async def _store(self, key, response):
+        writes = _cache_writes.get()
+        if writes is None:
+            await self._cache_io(_put_cached_completion, self.response_cache, key, response)
+        else:
+            writes.append((key, response))
+
+    async def _complete(self, messages, model, base_urls, api_key, generation_params):
+        # Permanent errors fail at once; transient ones are retried with random exponential backoff
+        self.retry_budget.deposit()
+        record = self.telemetry.request_started(model)
+        attempt = 0
+        while True:
+            attempt += 1
+            base_url = None
+            try:
+                # The endpoint is chosen again on every attempt, so a retry can move away from a failing replica
+                base_url = self.balancer.choose(base_urls)
+                response = await self._attempt(messages, model, base_url, api_key, generation_params, record)
+                self.telemetry.request_finished(record, response)
+                return response
+            except Exception as e:
+                kind = errors.classify_error(e)
+                if kind == errors.CIRCUIT_OPEN:
+                    # Nothing was sent upstream: wait until the circuit half-opens, without spending an attempt or
+                    # the retry budget
+                    attempt -= 1
+                    await asyncio.sleep(e.retry_in + random.uniform(0.1, 1.0))
+                    continue
+                if (kind == errors.PERMANENT or attempt >= self.max_attempts
+                        or (kind == errors.TRANSIENT and not self.retry_budget.withdraw())):
+                    self.failures[kind] = self.failures.get(kind, 0) + 1
+                    self.telemetry.request_finished(record, outcome=kind)
+                    raise errors.RequestFailed(e, kind, attempt, base_url) from e
+            await asyncio.sleep(random.uniform(1, min(60, 2 ** attempt)))
+
+    async def _attempt(self, messages, model, base_url, api_key, generation_params, record):
+        client = self.clients.get(base_url, api_key)
+        limiter = self.concurrency.get(base_url) if self.concurrency is not None else None
+        rate_limiter = self.rate_limits.get(base_url, model)
+        reserved_tokens = await rate_limiter.acquire(messages, generation_params) if rate_limiter else 0
+        start_time = self.balancer.start(base_url)
+        try:
+            # The endpoint's in-flight slot is taken here rather than in the completion helpers, so that the send
+            # time excludes waiting for it
+            async with limiter.slot() if limiter is not None else contextlib.AsyncExitStack():
+                record.attempt(base_url)
+                if self.stop_when is not None and generation_params.get("n", 1) == 1:
+                    response = await streaming.stream_completion_until(client, model, messages, self.stop_predicate,
+                                                                       **generation_params)
+                else:
+                    response = await async_completion_openai_api(client, model, messages, stream=False,
+                                                                 **generation_params)
+        except Exception as e:
+            self.balancer.finish(base_url, start_time, e)
+            if rate_limiter:
+                rate_limiter.reconcile(reserved_tokens, None)
+            raise
+        self.balancer.finish(base_url, start_time)
+        if rate_limiter:
+            rate_limiter.reconcile(reserved_tokens, response.usage)
+        return response
+
+    async def _sample(self, key, messages, model, base_url, api_key, generation_params):
+        if self.single_flight is not None:
+            return await self.single_flight.do(key, lambda: self._complete(
+                messages, model, base_url, api_key, generation_params))
+        return await self._complete(messages, model, base_url, api_key, generation_params)
+
+    async def _sample_with_n(self, keys, messages, model, base_url, api_key, generation_params):
+        # Returns as many samples as the endpoint gave; an empty list if it rejects `n`
+        n_key = (model, base_url if isinstance(base_url, str) else tuple(base_url))
+        if n_key in self.n_unsupported:
+            return []
+        try:
+            response = await self._sample(tuple(keys), messages, model, base_url, api_key,
+                                          dict(generation_params, n=len(keys)))
+        except errors.RequestFailed as e:
+            if e.kind != errors.PERMANENT:
+                raise
+            response = None
+            print(f"{model} at {base_url} rejected n={len(keys)}, falling back to single requests: {e}")
+        samples = _split_choices(response) if response is not None else []
+        if len(samples) < len(keys):
+            self.n_unsupported.add(n_key)
+        return samples
+
+    async def query(self, messages, model, sample_num, base_url, api_key, generation_params, attempt=1):
+        # base_url may be a single URL or a list of replicas serving the same model
+        key_params = generation_params
+        if self.stop_when is not None:
+            key_params = dict(generation_params, stop_when=streaming.stop_key(self.stop_when))
+            if self.reasoning:
+                key_params["reasoning"] = True
+        if attempt != 1:
+            # A re-ask after the caller rejected the answer: neither the cached response nor an identical request in
+            # flight may stand in for it
+            key_params = dict(key_params, attempt=attempt)
+        keys = [cache.cache_key(model, messages, key_params, sample_index) for sample_index in range(sample_num)]
+        results = await self._cache_io(lambda: [_get_cached_completion(self.response_cache, key) for key in keys])
+        missing = [sample_index for sample_index, response in enumerate(results) if response is None]
+        if len(missing) < sample_num:
+            self.telemetry.cache_hit(sample_num - len(missing))
+            writes = _cache_writes.get()
+            if writes is not None:
+                writes.extend((keys[sample_index], None) for sample_index in range(sample_num)
+                              if results[sample_index] is not None)
+        if self.use_n and self.stop_when is None and len(missing) > 1:
+            samples = await self._sample_with_n([keys[i] for i in missing], messages, model, base_url, api_key,
+                                                generation_params)
+            for sample_index, sample in zip(missing, samples):
+                results[sample_index] = sample
+                await self._store(keys[sample_index], sample)
+            missing = missing[len(samples):]
+        # Remaining samples are independent requests, sent in parallel
+        samples = await asyncio.gather(*[self._sample(keys[sample_index], messages, model, base_url, api_key,
+                                                      generation_params) for sample_index in missing])
+        for sample_index, sample in zip(missing, samples):
+            results[sample_index] = sample
+            await self._store(keys[sample_index], sample)
+        return [response.choices[0].message.content for response in results]
+
+    async def aclose(self):
+        await self.clients.aclose()
+        if self.response_cache is not None:
+            # Queued cache writes are done in order, so this also waits for them
+            await self._cache_io(self.response_cache.flush)
+            self.cache_executor.shutdown(wait=False)
+
+    def report(self):
+        if self.concurrency is not None:
+            self.concurrency.report()
+        self.balancer.report()
+        if self.response_cache is not None:
+            self.response_cache.report(since=self.cache_counts)
+        if self.single_flight is not None and self.single_flight.saved:
+            print(f"De-duplicated {self.single_flight.saved} identical in-flight requests")
+        if self.failures:
+            print(f"Failed requests by error class: {self.failures}"
+                  + (f", retry budget exhausted {self.retry_budget.exhausted} times" if self.retry_budget.exhausted else ""))
+        self.telemetry.report()
+        self.telemetry.export()
+
+
+def _parse_responses(parse, responses):
+    # (result, None) if the parse callback accepts the responses, else (None, why it rejected them)
+    try:
+        result = parse(responses)
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    return result, (None if result is not None else "parse returned None")
+
+
+def _parse_failure(reason, responses, attempts):
+    return errors.RequestFailed(errors.ParseError(reason, responses), errors.PARSE, attempts)
+
+
+def _run(test_data, request_fn, max_workers, window, total, return_failures=False, **state_kwargs):
+    state = _RunState(max_workers, **state_kwargs)
+    stage_telemetry = state.telemetry
+    if total is None and hasattr(test_data, "__len__"):
+        total = len(test_data)
+    try:
+        for item in engine.run_requests(stage_telemetry.track_input(test_data),
+                                        lambda obj: stage_telemetry.run_item(obj, lambda: state.run_item(
+                                            obj, lambda attempt: request_fn(obj, state, attempt))),
+                                        max_workers=max_workers, window=window, total=total,
+                                        return_failures=return_failures):
+            stage_telemetry.consumed(item[1])
+            # Time spent in the caller's loop body (parsing, writing) between two results
+            consumer_start = time.monotonic()
+            yield item
+            stage_telemetry.consumer_busy(time.monotonic() - consumer_start)
+    finally:
+        engine.run_on_loop(state.aclose())
+        state.report()
+
+
+def process_data_async(test_data, model, sample_num, base_url, api_key, generation_params, max_workers=32,
+                       window=None, total=None, **options):
+    # All requests run as coroutines on a single event loop thread; max_workers bounds the requests in flight.
+    # test_data can be any iterable (e.g. iter_jsonl_file): items are pulled lazily and at most `window` of them
+    # (default 2 * max_workers) are held between submission and being yielded, so memory stays flat.
+    # base_url may also be a list of replicas: each request then goes to the one expected to answer first.
+    # Further options (see _RunState):
+    #   http2: use HTTP/2 connections (requires the h2 package)
+    #   adaptive_concurrency (default True): per-base_url AIMD in-flight limits with max_workers as the ceiling,
+    #       backing off on 429/5xx/timeouts or rising latency; the settled limits are printed at the end of the run
+    #   deduplicate (default True): byte-identical requests (same model, messages, params and sample index) in
+    #       flight at the same time are sent once and the response is shared
+    #   rate_limits: {base_url or (base_url, model): {"rpm": ..., "tpm": ...}}, paces requests to stay under quota
+    #   max_attempts, retry_budget_ratio: permanent errors (400, context length, auth) fail at once; transient ones
+    #       (429, 5xx, timeouts) are retried up to max_attempts times while the run's retry budget lasts, and an
+    #       endpoint that keeps failing is cut off by its circuit breaker for a while
+    #   use_n (default False): ask for all sample_num samples in one request with `n`, falling back to parallel
+    #       single requests when the endpoint rejects or ignores it
+    #   stop_when: closing tag (e.g. "</decision>") or predicate on the text generated so far; responses are then
+    #       streamed and cut off as soon as it is satisfied, returning the partial text. Closing tags inside the
+    #       reasoning (up to the last </think>) do not count
+    #   reasoning (default False): the model thinks before answering, see streaming.closing_tag_predicate
+    #   return_failures (default False): also yield (errors.RequestFailed, obj) for items that failed, instead of
+    #       only printing the error
+    #   parse, max_parse_attempts (default 3): parse(responses) turns an item's responses into the stage's result;
+    #       returning None or raising rejects the answer, which is then asked again at once, up to
+    #       max_parse_attempts times in all. The generator yields (result, obj) instead of (responses, obj); items
+    #       whose every answer was rejected fail with kind errors.PARSE, their last responses in .error.responses.
+    #       Rejected answers are not kept in the response cache, so a rerun asks for them again. Accepted /
+    #       rejected / given-up counts are part of the stage's telemetry
+    # An item may carry "query_attempt" (default 1) when it is asked again because its answer could not be parsed;
+    # later attempts bypass the response cache and in-flight de-duplication.
+    #   stage, telemetry_dir: per-request telemetry (queue wait, time to first byte, latency, tokens, retries per
+    #       endpoint, and how long the caller's loop body takes) is accumulated under `stage` (default: the script
+    #       name) and written to telemetry_dir/<stage>.json and .prom every 30 s and at the end of the run;
+    #       telemetry_dir defaults to $FEEDBACKER_TELEMETRY_DIR or outputs/telemetry, "" disables the files
+    print(f"process_data started with max workers of {max_workers}")
+
+    async def request_fn(obj, state, attempt):
+        return await state.query(obj["input_ques"], model, sample_num, base_url, api_key, generation_params,
+                                 attempt=attempt)
+
+    yield from _run(test_data, request_fn, max_workers, window, total, **options)
+
+
+def process_data_async_spe_model(test_data, sample_num, generation_params, max_workers=32, window=None, total=None,
+                                 **options):
     # Compared to process_data_async, this function allows specifying the model, facilitating simultaneous generation with multiple models
     # test_data[i]["query_model"] as the model
-    # test_data[i]["query_base_url"] as the URL
+    # test_data[i]["query_base_url"] as the URL, or a list of URLs to balance between at dispatch time
     # test_data[i]["query_api_key"] as the API key
     print(f"process_data started with max workers of {max_workers}")
-    futures = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        for obj in test_data:
-            future = executor.submit(api_query, obj["input_ques"], obj["query_model"], sample_num,
-                                     obj["query_base_url"], obj["query_api_key"], generation_params)
-            futures.append((future, obj))
-        future_to_obj = {future: obj for future, obj in futures}
-        for future in tqdm(as_completed(future_to_obj.keys()), total=len(test_data)):  # Process results in completion order
-            obj = future_to_obj[future]
-            try:
-                responses = future.result()
-                yield responses, obj
-            except Exception as e:
-                print(f"Error processing item: {e}")
+
+    async def request_fn(obj, state, attempt):
+        return await state.query(obj["input_ques"], obj["query_model"], sample_num, obj["query_base_url"],
+                                 obj["query_api_key"], generation_params, attempt=attempt)
+
+    yield from _run(test_data, request_fn, max_workers, window, total, **options)
+
+
+def _batch_backend(kind, work_dir, base_url, api_key, max_workers, options):
+    if kind == "openai":
+        # A batch API is a single endpoint; streaming cut-off does not apply to batch jobs
+        return batch.OpenAIBatchBackend(base_url if isinstance(base_url, str) else base_url[0], api_key)
+    if kind == "local":
+        return batch.LocalBatchBackend(work_dir, base_url, api_key, process_data_async_spe_model,
+                                       max_workers=max_workers, **options)
+    raise ValueError(f"Unknown batch backend: {kind}")
+
+
+def _merge_batch_results(backend, entry, results_writer, batch_errors):
+    # Successful output lines go into the job's results file; failed ones are reported and resubmitted next run
+    for record in backend.results(entry["batch_id"]):
+        if batch.output_contents(record) is None:
+            batch_errors[record.get("custom_id")] = batch.output_error(record)
+            continue
+        results_writer.write(record)
+    entry["merged"] = True
+
+
+def _batch_params(sample_num, generation_params):
+    return dict(generation_params, n=sample_num) if sample_num > 1 else dict(generation_params)
+
+
+def _batch_results_path(work_dir, job_name):
+    return os.path.join(work_dir, f"{job_name or telemetry.default_stage()}.results.jsonl")
+
+
+def _skip_rejected_results(items, attempts, target_fn, sample_num, generation_params, parse, results_path):
+    # Results are kept by custom_id, so a rerun would get back the answers an earlier run rejected: each item starts
+    # at its first attempt without a rejected result instead
+    if not os.path.exists(results_path):
+        return
+    params = _batch_params(sample_num, generation_params)
+    with jsonl_index.JsonlIndex(results_path, key="custom_id") as results:
+        for obj in items:
+            model = target_fn(obj)[0]
+            attempt = obj.get("query_attempt", 1)
+            while True:
+                record = results.get(batch.custom_id(model, obj["input_ques"], params, attempt=attempt))
+                responses = batch.output_contents(record) if record is not None else None
+                if not responses or len(responses) < sample_num or \
+                        _parse_responses(parse, responses[:sample_num])[0] is not None:
+                    break
+                attempt += 1
+            if attempt != obj.get("query_attempt", 1):
+                attempts[id(obj)] = attempt
+
+
+def _run_batch(test_data, target_fn, sample_num, generation_params, work_dir, job_name, backend, poll_interval,
+               max_workers, return_failures, attempts=None, **options):
+    os.makedirs(work_dir, exist_ok=True)
+    job_name = job_name or telemetry.default_stage()
+    params = _batch_params(sample_num, generation_params)
+    results_path = _batch_results_path(work_dir, job_name)
+    state_path = os.path.join(work_dir, f"{job_name}.batches.json")
+    poll_interval = poll_interval if poll_interval is not None else (2 if backend == "local" else 30)
+
+    # Group the items by endpoint; identical requests share one custom_id and are sent once
+    items = []
+    groups = {}
+    for obj in test_data:
+        model, base_url, api_key = target_fn(obj)
+        attempt = attempts.get(id(obj)) if attempts and id(obj) in attempts else obj.get("query_attempt", 1)
+        request_id = batch.custom_id(model, obj["input_ques"], params, attempt=attempt)
+        items.append((request_id, obj, base_url))
+        group = groups.setdefault((model, json.dumps(base_url), api_key), {})
+        group[request_id] = obj["input_ques"]
+    print(f"Batch job {job_name}: {len(items)} items, {sum(len(group) for group in groups.values())} unique requests")
+
+    state = batch.load_state(state_path)
+    backends = {}
+    batch_errors = {}
+
+    def get_backend(kind, model, base_url_key, api_key):
+        key = (kind, base_url_key, api_key)
+        if key not in backends:
+            backends[key] = _batch_backend(kind, work_dir, json.loads(base_url_key), api_key, max_workers, options)
+        return backends[key]
+
+    def wait(entries):
+        pending = [entry for entry in entries if not entry.get("merged")]
+        while pending:
+            for entry in list(pending):
+                try:
+                    status, finished, total = entry["_backend"].status(entry["batch_id"])
+                except Exception as e:
+                    print(f"Polling batch {entry['batch_id']} failed, retrying: {e}")
+                    continue
+                entry["status"] = status
+                if status in batch.TERMINAL_STATUSES:
+                    with JsonlWriter(results_path, index_key="custom_id") as results_writer:
+                        _merge_batch_results(entry["_backend"], entry, results_writer, batch_errors)
+                    batch.save_state(state_path, [{k: v for k, v in e.items() if k != "_backend"} for e in state])
+                    pending.remove(entry)
+                    print(f"Batch {entry['batch_id']} {status}")
+                else:
+                    print(f"Batch {entry['batch_id']} {status}: {finished}/{total if total is not None else '?'}")
+            if pending:
+                time.sleep(poll_interval)
+
+    # 1. Collect batches submitted by an earlier run of this job
+    unfinished = []
+    for entry in state:
+        if entry.get("merged"):
+            continue
+        group_key = next((key for key in groups if key[0] == entry["model"] and key[1] == entry["base_url"]), None)
+        if group_key is None:
+            print(f"Batch {entry['batch_id']} of an earlier run no longer matches any item, skipping it")
+            entry["merged"] = True
+            continue
+        entry["_backend"] = get_backend(entry["backend"], *group_key)
+        unfinished.append(entry)
+    wait(unfinished)
+
+    # 2. Submit what is neither in the results nor covered by a finished batch
+    open(results_path, 'a').close()
+    with jsonl_index.JsonlIndex(results_path, key="custom_id") as results:
+        submitted = []
+        for (model, base_url_key, api_key), requests in groups.items():
+            missing = [(request_id, messages) for request_id, messages in requests.items() if request_id not in results]
+            if not missing:
+                continue
+            requests_path = os.path.join(work_dir, f"{job_name}.{len(state)}.requests.jsonl")
+            with open(requests_path, 'w', encoding='utf-8') as file:
+                for request_id, messages in missing:
+                    file.write(json.dumps(batch.request_line(request_id, model, messages, params),
+                                          ensure_ascii=False) + "\n")
+            entry_backend = get_backend(backend, model, base_url_key, api_key)
+            entry = {"batch_id": entry_backend.submit(requests_path, metadata={"job": job_name}),
+                     "backend": backend, "model": model, "base_url": base_url_key, "num_requests": len(missing),
+                     "requests_path": requests_path, "merged": False}
+            print(f"Submitted batch {entry['batch_id']} with {len(missing)} requests for {model}")
+            state.append(entry)
+            batch.save_state(state_path, [{k: v for k, v in e.items() if k != "_backend"} for e in state])
+            entry["_backend"] = entry_backend
+            submitted.append(entry)
+    wait(submitted)
+
+    # 3. Hand the results back like process_data_async does, for the stage's own post-processing
+    with jsonl_index.JsonlIndex(results_path, key="custom_id") as results:
+        for request_id, obj, base_url in items:
+            record = results.get(request_id)
+            responses = batch.output_contents(record) if record is not None else None
+            if responses is not None and len(responses) >= sample_num:
+                yield responses[:sample_num], obj
+                continue
+            message = batch_errors.get(request_id, "missing from the batch output")
+            error = errors.RequestFailed(RuntimeError(message), errors.TRANSIENT, 1,
+                                         base_url if isinstance(base_url, str) else None)
+            print(f"Error processing item: {error}")
+            if return_failures:
+                yield error, obj
+
+
+def _run_batch_parsed(test_data, target_fn, sample_num, generation_params, work_dir, job_name, backend, poll_interval,
+                      max_workers, return_failures, parse=None, max_parse_attempts=3, **options):
+    # With a parse callback, rejected answers are submitted again as requests of their own (see batch.custom_id), in
+    # up to max_parse_attempts batch rounds
+    if parse is None:
+        yield from _run_batch(test_data, target_fn, sample_num, generation_params, work_dir, job_name, backend,
+                              poll_interval, max_workers, return_failures, **options)
+        return
+    stage_telemetry = telemetry.get_stage(options.get("stage"), options.get("telemetry_dir"))
+    attempts = {}
+    pending = list(test_data)
+    _skip_rejected_results(pending, attempts, target_fn, sample_num, generation_params, parse,
+                           _batch_results_path(work_dir, job_name))
+    for attempt_round in range(max_parse_attempts):
+        rejected = []
+        for responses, obj in _run_batch(pending, target_fn, sample_num, generation_params, work_dir, job_name,
+                                         backend, poll_interval, max_workers, True, attempts=attempts, **options):
+            if isinstance(responses, Exception):
+                if return_failures:
+                    yield responses, obj
                 continue
+            result, reason = _parse_responses(parse, responses)
+            if result is not None:
+                stage_telemetry.parse_result("accepted")
+                yield result, obj
+                continue
+            stage_telemetry.parse_result("rejected")
+            attempts[id(obj)] = attempts.get(id(obj), obj.get("query_attempt", 1)) + 1
+            rejected.append((obj, responses, reason))
+        pending = [obj for obj, _, _ in rejected]
+        if not pending or attempt_round + 1 == max_parse_attempts:
+            break
+        print(f"Batch job: {len(pending)} answers rejected by the parser, submitting them again")
+    for obj, responses, reason in rejected:
+        stage_telemetry.parse_result("gave_up")
+        error = _parse_failure(reason, responses, max_parse_attempts)
+        print(f"Error processing item: {error}")
+        if return_failures:
+            yield error, obj
+
+
+def process_data_batch(test_data, model, sample_num, base_url, api_key, generation_params, work_dir,
+                       job_name=None, backend="local", poll_interval=None, max_workers=32, return_failures=False,
+                       **options):
+    """
+    Batch-job counterpart of process_data_async, yielding the same (responses, obj) pairs once the jobs are done.
+
+    Pending items are written to OpenAI batch-format request files in `work_dir`, submitted, polled until finished,
+    and their results merged into ``<job_name>.results.jsonl``. Requests are keyed by content, so rerunning after
+    a crash picks up batches already submitted (``<job_name>.batches.json``) and only submits what has no result.
+
+    :param backend: "openai" for the Batch API of base_url, or "local" to run the request files through the
+        request engine in this process (for servers without a batch API); options such as stop_when only apply there
+    :param job_name: Defaults to the script name
+    :param poll_interval: Seconds between status checks, default 30 (2 for the local backend)
+    :param parse, max_parse_attempts: As for process_data_async; rejected answers go into the next batch round
+    """
+    yield from _run_batch_parsed(test_data, lambda obj: (model, base_url, api_key), sample_num, generation_params,
+                                 work_dir, job_name, backend, poll_interval, max_workers, return_failures, **options)
+
+
+def process_data_batch_spe_model(test_data, sample_num, generation_params, work_dir, job_name=None, backend="local",
+                                 poll_interval=None, max_workers=32, return_failures=False, **options):
+    # Same as process_data_batch, with the model, base URL and API key taken from each item like
+    # process_data_async_spe_model; one batch is submitted per (model, base_url, api_key)
+    yield from _run_batch_parsed(test_data,
+                                 lambda obj: (obj["query_model"], obj["query_base_url"], obj["query_api_key"]),
+                                 sample_num, generation_params, work_dir, job_name, backend, poll_interval,
+                                 max_workers, return_failures, **options)
 
 
 if __name__ == "__main__":
     prompt_content = read_prompt("./data/prompts/test.json")
-    print(prompt_content)
\ No newline at end of file
+    print(prompt_content)
@@ -1,9 +1,18 @@
 import json
 import os
+import sys
 from collections import defaultdict
 import numpy as np
 import copy
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from utils import utils
+
+# Only these fields of the evaluation records are used here; the responses and judgments are dropped while parsing
+SCORE_FIELDS = ["id", "score", "meta_data"]
+
 
 def load_json(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -11,11 +20,7 @@ def load_json(file_path):
 
 
 def load_jsonl(file_path):
-    data = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            data.append(json.loads(line.strip()))
-    return data
+    return utils.read_jsonl_file(file_path, fields=SCORE_FIELDS)
 
 
 def save_json(data, file_path):